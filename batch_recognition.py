@@ -0,0 +1,78 @@
+import glob
+import os
+import time
+from multiprocessing import Pool
+import cv2
+
+import recognition
+from corner_detection import find_corners_in_photo
+from recognizer import Recognizer
+
+# Headless regression run over the test images: every image is decoded once, nothing is shown
+# or written to disk and the images are spread over a pool of processes.
+
+IMAGE_PATTERN = './test_images/images_with_pieces/*.jpg'
+
+def init_worker():
+    # every process gets its own image, OpenCV's own threads would only fight over the same cores
+    cv2.setNumThreads(1)
+
+def recognize_image(path_board):
+    number_of_corners = (recognition.corners_to_be_found, recognition.corners_to_be_found)
+    timings = {}
+    result = {"path": path_board, "board_found": False, "pieces": [], "timings": timings}
+
+    start = time.perf_counter()
+    img = cv2.imread(path_board)
+    timings["decode"] = time.perf_counter() - start
+    if img is None:
+        return result
+
+    start = time.perf_counter()
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray = cv2.medianBlur(gray, 13)
+    # the same cascade and corner order as recognition.main, so both give the same score
+    corners = find_corners_in_photo(gray, number_of_corners)
+    ret = corners is not None
+    timings["corners"] = time.perf_counter() - start
+
+    if ret:
+        start = time.perf_counter()
+        recognizer = Recognizer(recognition.BOARD_SIZE, verbose=False)
+        recognizer.set_corners(corners)
+        pieces = recognizer.recognize(img)["pieces"]
+        timings["pieces"] = time.perf_counter() - start
+
+        result["board_found"] = True
+        result["pieces"] = sorted(pieces)
+
+    timings["total"] = sum(timings.values())
+    return result
+
+def run_batch(paths, processes=None):
+    with Pool(processes=processes, initializer=init_worker) as pool:
+        results = pool.map(recognize_image, paths, chunksize=1)
+    return results
+
+def main(processes=None):
+    paths = [path for path in sorted(glob.glob(IMAGE_PATTERN)) if "_processed" not in path]
+
+    start = time.perf_counter()
+    results = run_batch(paths, processes)
+    wall_time = time.perf_counter() - start
+
+    for result in results:
+        timings = ", ".join(f"{stage} {1000 * seconds:.0f} ms" for stage, seconds in result["timings"].items())
+        if result["board_found"]:
+            print(f"Chessboard detected {result['path']}: {len(result['pieces'])} pieces ({timings})")
+        else:
+            print(f"No chessboard detected {result['path']} ({timings})")
+
+    number_succeeded = sum(result["board_found"] for result in results)
+    cpu_time = sum(result["timings"].get("total", 0) for result in results)
+    print("score:", number_succeeded, "off the", len(results), "boards were recognized")
+    print(f"{wall_time:.1f} s wall clock for {cpu_time:.1f} s of work on {processes or os.cpu_count()} processes")
+    return results
+
+if __name__ == "__main__":
+    main()
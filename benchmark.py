@@ -0,0 +1,230 @@
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+import instrumentation
+import recognition
+from corner_detection import find_corners_in_photo, photo_cascade
+from recognizer import Recognizer, get_ellipse_centers
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+# Times every stage of the recognition separately on all test images and writes the results to
+# benchmark_results/ as JSON, so two commits can be compared:
+#   python benchmark.py                                  run and save
+#   python benchmark.py benchmark_results/<old>.json     run, save and compare with an older run
+
+IMAGE_PATTERNS = [
+    './test_images/*.jpg',
+    './test_images/images_with_pieces/*.jpg',
+    './chessboardpattern-images/*.jpg',
+]
+RESULTS_DIR = "benchmark_results"
+# corners: the detection cascade of recognition.main without its cornerSubPix calls, which are timed as subpix
+# (per tier in results["cascade"]); the memory peak of the refinement is counted in corners
+STAGES = ["decode", "gray", "corners", "subpix", "grid", "masks", "ellipses", "matching"]
+PERCENTILES = [50, 90, 95, 99]
+
+def benchmark_paths(patterns=IMAGE_PATTERNS):
+    return [path for pattern in patterns for path in sorted(glob.glob(pattern)) if "_processed" not in path]
+
+def run_stages(path_board, recognizer, cascade, on_stage):
+    """
+    Runs the pipeline on one image, stage by stage. on_stage(name, function) runs the stage and
+    returns its result, so the caller decides how it is measured. Stops after the corner detection
+    when there is no board in the image. Returns the number of pieces or None.
+    """
+    img = on_stage("decode", lambda: cv2.imread(path_board))
+    if img is None:
+        return None
+    gray = on_stage("gray", lambda: recognizer.prepare_gray(img))
+    corners = on_stage("corners", lambda: find_corners_in_photo(gray, cascade.number_of_corners, cascade))
+    if corners is None:
+        return None
+    on_stage("grid", lambda: recognizer.set_corners(corners))
+
+    masks = on_stage("masks", lambda: recognizer.color_masks(img))
+    ellipses = on_stage("ellipses", lambda: {color: recognizer.detect_ellipses(mask) for color, mask in masks.items()})
+    pieces = on_stage("matching", lambda: [piece for color, shapes in ellipses.items()
+                                           for piece in recognizer.match_shapes_to_centers(
+                                               get_ellipse_centers(shapes), color)])
+    return len(set(pieces))
+
+def time_image(path_board, recognizer, cascade, repeat):
+    """Seconds per stage for every repetition: {stage: [seconds, ...]}, plus the number of pieces."""
+    timings = {}
+    # the cascade times its cornerSubPix calls as instrumentation stages, that splits them off the corners
+    sink = instrumentation.enable(instrumentation.StatsSink())
+
+    def subpix_seconds():
+        return sum(stats["total"] for name, stats in sink.stages.items() if name.startswith("cornerSubPix"))
+
+    def timed(name, function):
+        subpix_before = subpix_seconds()
+        start = time.perf_counter()
+        value = function()
+        seconds = time.perf_counter() - start
+        if name == "corners" and value is not None:
+            subpix = subpix_seconds() - subpix_before
+            timings.setdefault("subpix", []).append(subpix)
+            seconds -= subpix
+        timings.setdefault(name, []).append(seconds)
+        return value
+
+    pieces = None
+    try:
+        for _ in range(repeat):
+            pieces = run_stages(path_board, recognizer, cascade, timed)
+    finally:
+        instrumentation.disable()
+    return timings, pieces
+
+def trace_image(path_board, recognizer, cascade):
+    """Peak of newly allocated memory per stage, in bytes (one separate run, tracing slows the stages down)."""
+    peaks = {}
+
+    def traced(name, function):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        value = function()
+        peaks[name] = tracemalloc.get_traced_memory()[1] - before
+        return value
+
+    tracemalloc.start()
+    try:
+        run_stages(path_board, recognizer, cascade, traced)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64) * 1000
+    summary = {"count": int(len(samples)), "mean_ms": float(samples.mean()),
+               "min_ms": float(samples.min()), "max_ms": float(samples.max())}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = float(np.percentile(samples, percentile))
+    return summary
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(paths, repeat=3):
+    number_of_corners = (recognition.corners_to_be_found, recognition.corners_to_be_found)
+    recognizer = Recognizer(recognition.BOARD_SIZE, verbose=False)
+    # the traced runs are slower, only the timed runs count in the statistics per tier
+    cascade = photo_cascade(number_of_corners)
+    traced_cascade = photo_cascade(number_of_corners)
+    stage_samples = {stage: [] for stage in STAGES}
+    stage_peaks = {stage: 0 for stage in STAGES}
+    images = []
+
+    start = time.perf_counter()
+    for path_board in paths:
+        peaks = trace_image(path_board, recognizer, traced_cascade)
+        timings, pieces = time_image(path_board, recognizer, cascade, repeat)
+        for stage, samples in timings.items():
+            stage_samples[stage] += samples
+        for stage, peak in peaks.items():
+            stage_peaks[stage] = max(stage_peaks[stage], peak)
+
+        image_total = sum(np.mean(samples) for samples in timings.values())
+        images.append({"path": path_board, "board_found": pieces is not None, "pieces": pieces,
+                       "total_ms": 1000 * image_total, "peak_bytes": max(peaks.values(), default=0)})
+        print(f"{path_board}: {'board found, ' + str(pieces) + ' pieces' if pieces is not None else 'no board'}, "
+              f"{1000 * image_total:.0f} ms")
+    wall_time = time.perf_counter() - start
+
+    stages = {}
+    for stage in STAGES:
+        if stage_samples[stage]:
+            stages[stage] = summarize(stage_samples[stage])
+            stages[stage]["peak_bytes"] = int(stage_peaks[stage])
+
+    totals = [image["total_ms"] / 1000 for image in images]
+    located = [stages[stage]["mean_ms"] for stage in ["masks", "ellipses", "matching"] if stage in stages]
+    return {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "repeat": repeat,
+        "images": images,
+        "stages": stages,
+        "cascade": {tier: {"attempts": stats["attempts"], "hits": stats["hits"],
+                           "mean_ms": 1000 * stats["seconds"] / stats["attempts"] if stats["attempts"] else None}
+                    for tier, stats in cascade.stats.items()},
+        "total": summarize(totals) if totals else None,
+        # a full image (decode up to matching) and a frame of a board that is already located (masks up to matching)
+        "throughput": {
+            "images_per_second": len(totals) / sum(totals) if totals else None,
+            "located_frames_per_second": 1000 / sum(located) if located else None,
+        },
+        "boards_found": sum(image["board_found"] for image in images),
+        "wall_time_s": wall_time,
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None,
+    }
+
+def save_results(results, results_dir=RESULTS_DIR):
+    os.makedirs(results_dir, exist_ok=True)
+    name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + (f"_{results['commit']}" if results["commit"] else "")
+    path = os.path.join(results_dir, name + ".json")
+    with open(path, 'w') as json_file:
+        json.dump(results, json_file, indent=4)
+    return path
+
+def print_results(results):
+    print(f"{'stage':10} {'mean':>9} " + " ".join(f"{'p' + str(percentile):>9}" for percentile in PERCENTILES) + f" {'peak MB':>9}")
+    for stage, summary in results["stages"].items():
+        print(f"{stage:10} {summary['mean_ms']:9.2f} " + " ".join(f"{summary[f'p{percentile}_ms']:9.2f}" for percentile in PERCENTILES)
+              + f" {summary['peak_bytes'] / 1e6:9.1f}")
+    for tier, stats in results.get("cascade", {}).items():
+        if stats["attempts"]:
+            print(f"  corners, tier {tier}: {stats['hits']} of {stats['attempts']} hits, {stats['mean_ms']:.1f} ms per attempt")
+    throughput = results["throughput"]
+    print(f"boards found: {results['boards_found']} of {len(results['images'])} images")
+    if throughput["images_per_second"]:
+        print(f"throughput: {throughput['images_per_second']:.2f} images/s, "
+              f"{throughput['located_frames_per_second'] or 0:.1f} frames/s once the board is located")
+    if results["max_rss_bytes"]:
+        print(f"max RSS {results['max_rss_bytes'] / 1e6:.0f} MB")
+    print(f"wall clock {results['wall_time_s']:.1f} s")
+
+def compare_results(previous, current):
+    """Prints the change of the median time per stage, slower stages get a '!'."""
+    print(f"compared with {previous.get('commit')} ({previous.get('timestamp')}):")
+    for stage, summary in current["stages"].items():
+        if stage not in previous["stages"]:
+            continue
+        before, after = previous["stages"][stage]["p50_ms"], summary["p50_ms"]
+        change = (after - before) / before if before else 0.0
+        print(f"{stage:10} p50 {before:9.2f} -> {after:9.2f} ms ({change:+.0%}){' !' if change > 0.1 else ''}")
+
+def main(previous_path=None, repeat=3):
+    results = run_benchmark(benchmark_paths(), repeat)
+    print_results(results)
+    print("results written to", save_results(results))
+
+    if previous_path is not None:
+        with open(previous_path) as json_file:
+            compare_results(json.load(json_file), results)
+    return results
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,102 @@
+import os
+import cv2
+import numpy as np
+
+from instrumentation import timed
+
+# The camera does not move between two moves, so the expensive chessboard detection only
+# has to run once per camera setup. The result is stored per camera and resolution and
+# a couple of corner patches are compared on every frame to see if the board was moved.
+
+CACHE_DIR = "board_cache"
+PATCH_RADIUS = 12
+MIN_CORRELATION = 0.6
+
+# indices into the 14x14 inner corners: the four outer corners, the middle of each side and the center
+SAMPLE_CORNERS = [(0, 0), (0, 13), (13, 0), (13, 13), (0, 7), (7, 0), (13, 7), (7, 13), (7, 7)]
+
+_loaded_geometries = {}
+
+def get_cache_path(camera_id, resolution):
+    width, height = resolution
+    return os.path.join(CACHE_DIR, f"camera_{camera_id}_{width}x{height}.npz")
+
+def sample_corner_patches(gray, corners):
+    """
+    Cut a small square patch around every sampled corner.
+    Returns None if one of the patches falls outside of the image.
+    """
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 2)
+    corners_per_row = int(np.sqrt(len(corners)))
+    patches = []
+    for i, j in SAMPLE_CORNERS:
+        x, y = np.rint(corners[i * corners_per_row + j]).astype(int)
+        if x - PATCH_RADIUS < 0 or y - PATCH_RADIUS < 0:
+            return None
+        patch = gray[y - PATCH_RADIUS:y + PATCH_RADIUS + 1, x - PATCH_RADIUS:x + PATCH_RADIUS + 1]
+        if patch.shape != (2 * PATCH_RADIUS + 1, 2 * PATCH_RADIUS + 1):
+            return None
+        patches.append(patch)
+    return np.array(patches, dtype=np.uint8)
+
+def save_board_geometry(camera_id, resolution, gray, corners, grid, avg_distances):
+    geometry = {
+        "corners": np.asarray(corners, dtype=np.float32).reshape(-1, 2),
+        "homography": grid.homography,
+        "all_corners": grid.corners(),
+        "cell_centers": grid.cell_centers(),
+        "avg_distances": np.asarray(avg_distances, dtype=np.float64),
+        "patches": sample_corner_patches(gray, corners),
+    }
+    _loaded_geometries[(camera_id, tuple(resolution))] = geometry
+
+    if geometry["patches"] is None:
+        # without reference patches the drift check can not run, so don't persist this one
+        return geometry
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    np.savez(get_cache_path(camera_id, resolution), **geometry)
+    return geometry
+
+def load_board_geometry(camera_id, resolution):
+    key = (camera_id, tuple(resolution))
+    if key in _loaded_geometries:
+        return _loaded_geometries[key]
+
+    path = get_cache_path(camera_id, resolution)
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as data:
+        geometry = {name: data[name] for name in data.files}
+    _loaded_geometries[key] = geometry
+    return geometry
+
+def forget_board_geometry(camera_id, resolution):
+    _loaded_geometries.pop((camera_id, tuple(resolution)), None)
+    path = get_cache_path(camera_id, resolution)
+    if os.path.exists(path):
+        os.remove(path)
+
+@timed("board_has_moved")
+def board_has_moved(gray, geometry, min_correlation=MIN_CORRELATION):
+    """
+    Cheap drift check: compare the stored corner patches with the same patches in the new frame.
+    A piece or a hand can cover a few corners, so the board only counts as moved when
+    the majority of the patches no longer match.
+    """
+    reference = geometry.get("patches")
+    if reference is None:
+        return True
+
+    current = sample_corner_patches(gray, geometry["corners"])
+    if current is None:
+        return True
+
+    matching = 0
+    for old_patch, new_patch in zip(reference, current):
+        score = cv2.matchTemplate(new_patch, old_patch, cv2.TM_CCOEFF_NORMED)[0, 0]
+        if score >= min_correlation:
+            matching += 1
+
+    return matching <= len(reference) // 2
@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+from board_server import HOST, PORT
+
+# Stand-in for the game engine: connects to the board server and prints every state and move.
+# Run board_server.py (or serve() in recognition_version to built-in.py) first.
+
+def describe(message):
+    if message["type"] == "state":
+        return f"state: {len(message['pieces'])} pieces"
+    if message["type"] == "move":
+        added = ", ".join(f"{color} on {tuple(cell)}" for color, cell in message["added"])
+        removed = ", ".join(f"{color} from {tuple(cell)}" for color, cell in message["removed"])
+        return f"move at {message['timestamp']}: added {added or 'nothing'}; removed {removed or 'nothing'}"
+    return json.dumps(message)
+
+async def receive(host=HOST, port=PORT, number_of_messages=None):
+    """Prints the messages of the server, returns them when number_of_messages have arrived or the server stops."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"command": "ping"}\n')
+    await writer.drain()
+
+    messages = []
+    while number_of_messages is None or len(messages) < number_of_messages:
+        line = await reader.readline()
+        if not line:
+            break
+        message = json.loads(line)
+        messages.append(message)
+        print(describe(message))
+
+    writer.close()
+    return messages
+
+def main(host=HOST, port=PORT):
+    try:
+        asyncio.run(receive(host, port))
+    except ConnectionRefusedError:
+        print(f"No board server on {host}:{port}")
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
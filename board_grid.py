@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+BOARD_SIZE = 15
+
+class BoardGrid:
+    """
+    Perspective model of the board: a homography from board coordinates to image pixels.
+    In board coordinates the corners of the board are the whole numbers 0..BOARD_SIZE,
+    so the corner in row i and column j lies at (j, i) and the center of that cell at (j + 0.5, i + 0.5).
+    """
+
+    def __init__(self, homography, board_size=BOARD_SIZE):
+        self.board_size = board_size
+        self.homography = np.asarray(homography, dtype=np.float64)
+        self.inverse = np.linalg.inv(self.homography)
+
+    @classmethod
+    def fit(cls, corners, board_size=BOARD_SIZE):
+        """Fit the grid on the inner corners found by findChessboardCorners(SB), in row-major order."""
+        inner = board_size - 1
+        columns, rows = np.meshgrid(np.arange(1, board_size), np.arange(1, board_size))
+        board_points = np.stack([columns, rows], axis=-1).reshape(-1, 2).astype(np.float32)
+        image_points = np.asarray(corners, dtype=np.float32).reshape(inner * inner, 2)
+        homography, _ = cv2.findHomography(board_points, image_points, 0)
+        return cls(homography, board_size)
+
+    def board_to_image(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(points, self.homography).reshape(-1, 2)
+
+    def image_to_board(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(points, self.inverse).reshape(-1, 2)
+
+    def corners(self):
+        """All (board_size + 1) x (board_size + 1) corners, including the outer ring the detector can't find."""
+        size = self.board_size + 1
+        columns, rows = np.meshgrid(np.arange(size), np.arange(size))
+        points = np.stack([columns, rows], axis=-1).reshape(-1, 2)
+        return self.board_to_image(points).reshape(size, size, 2).astype(np.float32)
+
+    def cell_centers(self):
+        """Centers of all cells in row-major order, so cell index = row * board_size + column."""
+        columns, rows = np.meshgrid(np.arange(self.board_size), np.arange(self.board_size))
+        points = np.stack([columns, rows], axis=-1).reshape(-1, 2) + 0.5
+        return self.board_to_image(points)
+
+    def pixel_to_cell(self, x, y):
+        """Returns (row, column) of the cell that contains pixel (x, y), or None when it is not on the board."""
+        h = self.inverse
+        w = h[2, 0] * x + h[2, 1] * y + h[2, 2]
+        column = int(np.floor((h[0, 0] * x + h[0, 1] * y + h[0, 2]) / w))
+        row = int(np.floor((h[1, 0] * x + h[1, 1] * y + h[1, 2]) / w))
+        if 0 <= row < self.board_size and 0 <= column < self.board_size:
+            return (row, column)
+        return None
+
+    def pixels_to_cells(self, points):
+        """Cell index for every point, -1 for points that are not on the board."""
+        board_points = np.floor(self.image_to_board(points)).astype(int)
+        columns, rows = board_points[:, 0], board_points[:, 1]
+        on_board = (columns >= 0) & (columns < self.board_size) & (rows >= 0) & (rows < self.board_size)
+        return np.where(on_board, rows * self.board_size + columns, -1)
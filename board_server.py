@@ -0,0 +1,142 @@
+import asyncio
+import glob
+import json
+import threading
+import time
+
+from result_publisher import ResultPublisher
+
+# The game engine gets the board over a local TCP connection instead of polling detected_pieces.json.
+# Every message is one line of JSON:
+#   {"type": "state", "timestamp": ..., "pieces": [[color, [row, column]], ...], "board": ...}   on connect and on request
+#   {"type": "move", "timestamp": ..., "added": [...], "removed": [...], "pieces": [...], "board": ...}   every change
+# board is the compact form of the state (BoardState.to_string: one digit per cell, see board_state.py).
+# A client can send {"command": "state"} for the current state or {"command": "ping"} (answer: {"type": "pong"}).
+# serve() in recognition_version to built-in.py runs the server next to the camera loop,
+# python board_server.py replays the test images instead, python board_client.py shows what arrives.
+
+HOST = "127.0.0.1"
+PORT = 8765
+CLIENT_QUEUE_SIZE = 100
+
+def encode(message):
+    return (json.dumps(message, separators=(",", ":"), default=int) + "\n").encode()
+
+class BoardServer:
+    """
+    Serves the changes of a ResultPublisher to every connected client. The publisher calls back from
+    its own thread, the messages are handed to the event loop with call_soon_threadsafe.
+    A client that does not read and falls CLIENT_QUEUE_SIZE messages behind is disconnected.
+    """
+
+    def __init__(self, publisher, host=HOST, port=PORT):
+        self.publisher = publisher
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.clients = set()
+        self.last_state = self.state_message(publisher.state, None)
+        publisher.subscribe(self.on_change)
+
+    @staticmethod
+    def state_message(state, timestamp):
+        if state is None:
+            return {"type": "state", "timestamp": timestamp, "pieces": [], "board": None}
+        return {"type": "state", "timestamp": timestamp, "pieces": state.to_pieces(), "board": state.to_string()}
+
+    def on_change(self, change):
+        message = dict(change, type="move")
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast, message)
+
+    def broadcast(self, message):
+        self.last_state = {"type": "state", "timestamp": message["timestamp"], "pieces": message["pieces"],
+                           "board": message["board"]}
+        for client in list(self.clients):
+            if client.qsize() >= CLIENT_QUEUE_SIZE:
+                print("Client too slow, disconnecting it")
+                self.clients.discard(client)
+                client.put_nowait(None)
+            else:
+                client.put_nowait(message)
+
+    async def send_messages(self, messages, writer):
+        while True:
+            message = await messages.get()
+            if message is None:
+                # also ends the readline in handle_client
+                writer.close()
+                break
+            writer.write(encode(message))
+            await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        # a few places more than CLIENT_QUEUE_SIZE for the answers to commands and the None that ends send_messages
+        messages = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE + 10)
+        messages.put_nowait(self.last_state)
+        self.clients.add(messages)
+        sender = asyncio.ensure_future(self.send_messages(messages, writer))
+        print("Client connected", writer.get_extra_info("peername"))
+        try:
+            while not sender.done():
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    command = json.loads(line).get("command")
+                except (ValueError, AttributeError):
+                    command = None
+                if command == "state":
+                    messages.put_nowait(self.last_state)
+                elif command == "ping":
+                    messages.put_nowait({"type": "pong"})
+                else:
+                    messages.put_nowait({"type": "error", "message": "unknown command"})
+        except (ConnectionError, asyncio.QueueFull):
+            pass
+        finally:
+            self.clients.discard(messages)
+            sender.cancel()
+            writer.close()
+            print("Client disconnected", writer.get_extra_info("peername"))
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        if self.publisher.state is not None:
+            self.last_state = self.state_message(self.publisher.state, None)
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        print(f"Serving the board on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+def replay_images(publisher, pattern='./test_images/images_with_pieces/*.jpg', interval=2.0):
+    """Stand-in for the camera: publishes the pieces of every test image in turn, over and over."""
+    from batch_recognition import recognize_image
+
+    paths = [path for path in sorted(glob.glob(pattern)) if "_processed" not in path]
+    results = {}
+    while paths:
+        for path in paths:
+            if path not in results:
+                results[path] = recognize_image(path)
+            if results[path]["board_found"]:
+                publisher.publish(results[path]["pieces"])
+                time.sleep(interval)
+        if not any(result["board_found"] for result in results.values()):
+            # nothing to replay: without this the loop would keep a core busy forever
+            print("No chessboard detected in", pattern, "- nothing to replay")
+            return
+
+def main(host=HOST, port=PORT):
+    publisher = ResultPublisher(path=None)
+    threading.Thread(target=replay_images, args=(publisher,), daemon=True).start()
+    BoardServer(publisher, host, port).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import numpy as np
+
+from cell_classifier import BLUE, COLOR_NAMES, EMPTY, RED
+
+# The board as a board_size x board_size int8 array with one value per cell. The colors are bits,
+# so a cell that was detected as red and as blue ends up as RED | BLUE = CONFLICT instead of
+# silently holding two pieces:
+#   0 EMPTY, 1 RED, 2 BLUE, 3 CONFLICT
+# The same encoding as the labels of cell_classifier, so those can be used directly.
+
+BOARD_SIZE = 15
+CONFLICT = RED | BLUE
+COLOR_CODES = {name: code for code, name in COLOR_NAMES.items()}
+
+class BoardState:
+    """
+    Immutable board state. Lookup of a cell is an array index, comparing and diffing two states is one
+    vectorized comparison and the hash only depends on the cells, so states can be used as dict keys.
+    """
+
+    def __init__(self, cells=None, board_size=BOARD_SIZE):
+        if cells is None:
+            cells = np.zeros((board_size, board_size), dtype=np.int8)
+        cells = np.array(cells, dtype=np.int8).reshape(board_size, board_size)
+        cells.flags.writeable = False
+        self.cells = cells
+        self.board_size = board_size
+        self._hash = None
+
+    @classmethod
+    def from_pieces(cls, pieces, board_size=BOARD_SIZE):
+        """From a list of (color, (row, column)), the format of Recognizer.recognize."""
+        cells = np.zeros(board_size * board_size, dtype=np.int8)
+        if pieces:
+            codes = np.array([COLOR_CODES[color] for color, _ in pieces], dtype=np.int8)
+            indices = np.array([row * board_size + column for _, (row, column) in pieces])
+            np.bitwise_or.at(cells, indices, codes)
+        return cls(cells, board_size)
+
+    @classmethod
+    def from_labels(cls, labels, board_size=BOARD_SIZE):
+        """From the row-major labels of cell_classifier.classify_cells."""
+        return cls(labels, board_size)
+
+    @classmethod
+    def from_string(cls, text):
+        """Inverse of to_string."""
+        board_size = int(round(len(text) ** 0.5))
+        return cls(np.frombuffer(text.encode(), dtype=np.uint8) - ord("0"), board_size)
+
+    @classmethod
+    def from_bitmasks(cls, red, blue, board_size=BOARD_SIZE):
+        """Inverse of to_bitmasks."""
+        number_of_cells = board_size * board_size
+        bits = [np.unpackbits(np.frombuffer(mask.to_bytes((number_of_cells + 7) // 8, "little"), dtype=np.uint8),
+                              bitorder="little")[:number_of_cells]
+                for mask in (red, blue)]
+        return cls(bits[0] * RED | bits[1] * BLUE, board_size)
+
+    def __getitem__(self, cell):
+        """state[row, column]: "red", "blue", None for an empty cell or "conflict"."""
+        code = int(self.cells[cell])
+        if code == EMPTY:
+            return None
+        return COLOR_NAMES.get(code, "conflict")
+
+    def __eq__(self, other):
+        return isinstance(other, BoardState) and np.array_equal(self.cells, other.cells)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.cells.tobytes())
+        return self._hash
+
+    def __repr__(self):
+        return f"BoardState({self.to_string()!r})"
+
+    def count(self, color):
+        return int(np.count_nonzero(self.cells == COLOR_CODES[color]))
+
+    def conflicts(self):
+        """Cells that were detected as red and as blue at the same time, as (row, column)."""
+        return [tuple(int(value) for value in cell) for cell in np.argwhere(self.cells == CONFLICT)]
+
+    def changed_cells(self, other):
+        """(row, column) of every cell that differs from other."""
+        return [tuple(int(value) for value in cell) for cell in np.argwhere(self.cells != other.cells)]
+
+    def diff(self, other):
+        """
+        What changed from other (the older state) to this state: (added, removed), lists of (color, (row, column)).
+        A piece that changed color is removed in its old color and added in its new one.
+        """
+        changed = self.cells != other.cells
+        added = BoardState(np.where(changed, self.cells & ~other.cells, EMPTY), self.board_size)
+        removed = BoardState(np.where(changed, other.cells & ~self.cells, EMPTY), self.board_size)
+        return added.to_pieces(), removed.to_pieces()
+
+    def to_pieces(self):
+        """The list of (color, (row, column)) in row-major order, a conflict gives a piece of both colors."""
+        pieces = []
+        for row, column in np.argwhere(self.cells != EMPTY):
+            code = int(self.cells[row, column])
+            for color_code in (RED, BLUE):
+                if code & color_code:
+                    pieces.append((COLOR_NAMES[color_code], (int(row), int(column))))
+        return pieces
+
+    def to_string(self):
+        """One digit per cell, row by row: 225 characters for the whole board."""
+        return (self.cells.reshape(-1).astype(np.uint8) + ord("0")).tobytes().decode()
+
+    def to_bitmasks(self):
+        """Two integers (red, blue) with bit row * board_size + column set for every piece of that color."""
+        flat = self.cells.reshape(-1)
+        return tuple(int.from_bytes(np.packbits((flat & code) != 0, bitorder="little").tobytes(), "little")
+                     for code in (RED, BLUE))
@@ -1,19 +1,16 @@
 import cv2
 import numpy as np
-#push c on your keyboard when you would like to calibrate the color
+
+from color_profiles import hue_ranges, update_profile
+from dominant_color import DominantColorEstimator
+
+#push c on your keyboard to start calibrating the color, the estimate follows the live image until you push c again
+#push s on your keyboard to select the part of the image with the pieces (an empty selection uses the whole image again)
+#push b or r on your keyboard to save the calibrated color as the blue or red pieces in the color profile
 #push q on your keyboard when you would like to quit
-def get_dominant_color(image, k=4, image_processing_size=None):
-    if image_processing_size is not None:
-        image = cv2.resize(image, image_processing_size, 
-                           interpolation=cv2.INTER_AREA)
-    pixels = np.float32(image.reshape(-1, 3))
-    n_colors = k
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, 0.1)
-    flags = cv2.KMEANS_RANDOM_CENTERS
-    _, labels, palette = cv2.kmeans(pixels, n_colors, None, criteria, 10, flags)
-    _, counts = np.unique(labels, return_counts=True)
-    dominant = palette[np.argmax(counts)]
-    return dominant
+#the recognition uses the profile when COLOR_PROFILE (or the environment variable COLOR_PROFILE) is set to its name
+
+PROFILE_NAME = "default"
 
 def get_color_bounds(hsv_color):
     sensitivity = 5
@@ -21,13 +18,16 @@ def get_color_bounds(hsv_color):
     upper_bound = np.array([hsv_color[0] + sensitivity, 255, 255])
     return lower_bound, upper_bound
 
-def main():
+def main(profile_name=PROFILE_NAME, board=None, lighting=None):
+    """board and lighting are only stored in the profile, as a description of the setup."""
     cap = cv2.VideoCapture(1)
     if not cap.isOpened():
         print("Error: Could not open webcam.")
         return
 
     calibrate = False
+    estimator = DominantColorEstimator()
+    roi = None
     lower_bound = None
     upper_bound = None
 
@@ -38,22 +38,12 @@ def main():
             break
 
         if calibrate:
-            # Convert frame to HSV
-            hsv_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-            # Get the dominant color in the frame
-            dominant_color_bgr = get_dominant_color(frame)
-            dominant_color_hsv = cv2.cvtColor(np.uint8([[dominant_color_bgr]]), 
-                                              cv2.COLOR_BGR2HSV)[0][0]
+            # a few thousand pixels per frame in a running histogram, the preview keeps running
+            dominant_color_hsv = estimator.update(frame, roi)
 
             # Get the color bounds for the dominant color
-            lower_bound, upper_bound = get_color_bounds(dominant_color_hsv)
-
-            # Print the color bounds
-            print("Lower bound:", lower_bound)
-            print("Upper bound:", upper_bound)
-
-            calibrate = False
+            if dominant_color_hsv is not None:
+                lower_bound, upper_bound = get_color_bounds(dominant_color_hsv)
 
         if lower_bound is not None and upper_bound is not None:
             # Convert frame to HSV
@@ -65,14 +55,32 @@ def main():
             # Show the mask
             cv2.imshow("Mask", mask)
 
+        if roi is not None:
+            x, y, width, height = roi
+            frame = cv2.rectangle(frame.copy(), (x, y), (x + width, y + height), (0, 255, 0), 2)
         cv2.imshow("Frame", frame)
 
         key = cv2.waitKey(1) & 0xFF
         if key == ord('q'):
             break
         elif key == ord('c'):
-            calibrate = True
+            calibrate = not calibrate
+            if calibrate:
+                estimator.reset()
+            else:
+                # Print the color bounds
+                print("Lower bound:", lower_bound)
+                print("Upper bound:", upper_bound)
+        elif key == ord('s'):
+            x, y, width, height = cv2.selectROI("Frame", frame)
+            roi = (x, y, width, height) if width > 0 and height > 0 else None
+            estimator.reset()
+        elif key in (ord('b'), ord('r')) and lower_bound is not None:
+            color = "blue" if key == ord('b') else "red"
+            path = update_profile(profile_name, color, hue_ranges(lower_bound, upper_bound), board, lighting)
+            print("Saved the", color, "pieces in", path)
 
+    estimator.report()
     cap.release()
     cv2.destroyAllWindows()
 
@@ -0,0 +1,214 @@
+import collections
+import glob
+import os
+import cv2
+import numpy as np
+
+from board_grid import BOARD_SIZE, BoardGrid
+from corner_detection import find_corners_in_photo, photo_cascade
+from instrumentation import timed
+from recognizer import FrameBuffers
+
+# The board is found in the raw camera image: bent by the lens and seen at an angle, so the cells
+# far from the camera are smaller than the ones close by. A one-time calibration on photos of the board
+# (calibrateCamera, the board itself is the calibration pattern) gives the camera matrix and the
+# distortion coefficients, stored per camera and resolution in camera_calibration/.
+# BoardRectifier combines undistortion and perspective in one remap table per board position, so
+# every frame is warped with a single remap into a small top-down image of constant size in which
+# every cell is cell_size x cell_size pixels. The recognition then works on that image with a
+# regular grid (rectified_grid) instead of on the full camera frame.
+
+CALIBRATION_DIR = "camera_calibration"
+CELL_SIZE = 40 # pixels per cell in the rectified image
+MARGIN = 0.5 # cells around the board in the rectified image, so the pieces on the edge are not cut off
+
+def get_calibration_path(camera_id, resolution, calibration_dir=CALIBRATION_DIR):
+    width, height = resolution
+    return os.path.join(calibration_dir, f"camera_{camera_id}_{width}x{height}.npz")
+
+def board_object_points(board_size=BOARD_SIZE):
+    """The inner corners of the board in cells, z = 0, in the row-major order of the detection."""
+    columns, rows = np.meshgrid(np.arange(1, board_size), np.arange(1, board_size))
+    points = np.stack([columns, rows, np.zeros_like(columns)], axis=-1).reshape(-1, 3)
+    return points.astype(np.float32)
+
+def calibrate_camera(paths, board_size=BOARD_SIZE, min_views=3):
+    """
+    calibrateCamera on the board in every image of paths (all with the same resolution).
+    Returns the calibration ({"camera_matrix", "dist_coeffs", "resolution", "rms", "views"}) or None
+    when the board was found in fewer than min_views images.
+    """
+    corners_to_be_found = board_size - 1
+    number_of_corners = (corners_to_be_found, corners_to_be_found)
+    cascade = photo_cascade(number_of_corners)
+    object_points = []
+    image_points = []
+    resolution = None
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        if resolution is None:
+            resolution = (img.shape[1], img.shape[0])
+        elif resolution != (img.shape[1], img.shape[0]):
+            print(f"{path}: skipped, {img.shape[1]}x{img.shape[0]} instead of {resolution[0]}x{resolution[1]}")
+            continue
+        gray = cv2.medianBlur(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 13)
+        corners = find_corners_in_photo(gray, number_of_corners, cascade)
+        if corners is None:
+            print(f"{path}: no chessboard detected")
+            continue
+        object_points.append(board_object_points(board_size))
+        image_points.append(corners)
+
+    if len(image_points) < min_views:
+        print(f"Only {len(image_points)} usable images, at least {min_views} are needed")
+        return None
+
+    rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(object_points, image_points, resolution, None, None)
+    return {
+        "camera_matrix": camera_matrix,
+        "dist_coeffs": dist_coeffs.reshape(-1),
+        "resolution": np.array(resolution),
+        "rms": np.float64(rms),
+        "views": np.int64(len(image_points)),
+    }
+
+def save_calibration(camera_id, calibration, calibration_dir=CALIBRATION_DIR):
+    os.makedirs(calibration_dir, exist_ok=True)
+    path = get_calibration_path(camera_id, calibration["resolution"], calibration_dir)
+    np.savez(path, **calibration)
+    return path
+
+def load_calibration(camera_id, resolution, calibration_dir=CALIBRATION_DIR):
+    """The stored calibration of this camera and resolution, or None when it has not been calibrated."""
+    path = get_calibration_path(camera_id, resolution, calibration_dir)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+class BoardRectifier:
+    """
+    Warps the board of a camera frame into a top-down image of constant size. Without a calibration
+    only the perspective is removed, with one the lens distortion as well.
+    set_corners once per board position (that builds the remap table), then rectify every frame.
+    """
+
+    def __init__(self, calibration=None, board_size=BOARD_SIZE, cell_size=CELL_SIZE, margin=MARGIN):
+        self.board_size = board_size
+        self.cell_size = cell_size
+        self.margin = margin
+        self.camera_matrix = None
+        self.dist_coeffs = None
+        if calibration is not None:
+            self.camera_matrix = np.asarray(calibration["camera_matrix"], dtype=np.float64)
+            self.dist_coeffs = np.asarray(calibration["dist_coeffs"], dtype=np.float64)
+
+        side = int(round((board_size + 2 * margin) * cell_size))
+        self.shape = (side, side)
+        offset = margin * cell_size
+        self.grid = None # the board in the undistorted camera image
+        self.rectified_grid = BoardGrid([[cell_size, 0, offset], [0, cell_size, offset], [0, 0, 1]], board_size)
+        self.maps = None
+        self.undistort_maps = None
+        self.buffers = FrameBuffers()
+
+    def avg_distances(self):
+        """The spacing of the cells in the rectified image, for Recognizer.set_grid."""
+        return float(self.cell_size), float(self.cell_size)
+
+    def undistort_points(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if self.camera_matrix is None:
+            return points.reshape(-1, 2)
+        return cv2.undistortPoints(points, self.camera_matrix, self.dist_coeffs, P=self.camera_matrix).reshape(-1, 2)
+
+    def distort_points(self, points):
+        """Undistorted pixel coordinates back to the raw camera image (where remap has to read)."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.camera_matrix is None:
+            return points
+        # rays through the undistorted pixels, projected again with the distortion of the lens
+        rays = np.concatenate([points, np.ones((len(points), 1))], axis=1) @ np.linalg.inv(self.camera_matrix).T
+        if len(self.dist_coeffs) > 8:
+            # thin prism or tilted models: let OpenCV do it (projectPoints is a lot slower on a whole table)
+            zero = np.zeros(3)
+            image_points, _ = cv2.projectPoints(rays, zero, zero, self.camera_matrix, self.dist_coeffs)
+            return image_points.reshape(-1, 2)
+
+        # the distortion model of OpenCV: k1, k2, p1, p2[, k3[, k4, k5, k6]]
+        k1, k2, p1, p2, k3, k4, k5, k6 = np.concatenate([self.dist_coeffs, np.zeros(8 - len(self.dist_coeffs))])
+        x, y = rays[:, 0], rays[:, 1]
+        r2 = x * x + y * y
+        radial = (1 + r2 * (k1 + r2 * (k2 + r2 * k3))) / (1 + r2 * (k4 + r2 * (k5 + r2 * k6)))
+        distorted_x = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+        distorted_y = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+        distorted = np.stack([distorted_x, distorted_y, np.ones_like(x)], axis=-1) @ self.camera_matrix.T
+        return distorted[:, :2]
+
+    @timed("BoardRectifier.set_corners")
+    def set_corners(self, corners):
+        """
+        Fit the grid on the undistorted inner corners of the raw frame and build the remap table:
+        for every pixel of the rectified image the position in the raw frame.
+        """
+        self.grid = BoardGrid.fit(self.undistort_points(corners), self.board_size)
+        height, width = self.shape
+        columns, rows = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+        pixels = np.stack([columns, rows], axis=-1).reshape(-1, 2)
+        board_points = self.rectified_grid.image_to_board(pixels)
+        raw_points = self.distort_points(self.grid.board_to_image(board_points)).reshape(height, width, 2)
+        # fixed point maps: remap with CV_16SC2 tables is faster than with two float maps
+        self.maps = cv2.convertMaps(raw_points.astype(np.float32), None, cv2.CV_16SC2)
+
+    @timed("BoardRectifier.rectify")
+    def rectify(self, frame, dst=None):
+        """The top-down board, in dst or in a pooled buffer that the next frame overwrites."""
+        if self.maps is None:
+            raise ValueError("The board has not been located yet, call set_corners first.")
+        if dst is None:
+            dst = self.buffers.get("rectified", self.shape + frame.shape[2:])
+        return cv2.remap(frame, self.maps[0], self.maps[1], cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_REPLICATE)
+
+    def undistort(self, frame, dst=None):
+        """The whole frame without lens distortion, with remap tables that are computed once per resolution."""
+        if self.camera_matrix is None:
+            return frame
+        height, width = frame.shape[:2]
+        if self.undistort_maps is None or self.undistort_maps[0].shape[:2] != (height, width):
+            self.undistort_maps = cv2.initUndistortRectifyMap(self.camera_matrix, self.dist_coeffs, None,
+                                                              self.camera_matrix, (width, height), cv2.CV_16SC2)
+        if dst is None:
+            dst = self.buffers.get("undistorted", frame.shape, frame.dtype)
+        return cv2.remap(frame, self.undistort_maps[0], self.undistort_maps[1], cv2.INTER_LINEAR, dst=dst)
+
+def main(pattern='./test_images/*.jpg', camera_id=1):
+    """Calibrate camera_id on the photos of pattern with the most common resolution and store the result."""
+    # the resolution of every readable image, so the filter below does not have to decode them again
+    resolutions = {}
+    for path in sorted(glob.glob(pattern)):
+        img = cv2.imread(path)
+        if img is None:
+            print(f"{path}: could not be read")
+            continue
+        resolutions[path] = (img.shape[1], img.shape[0])
+    if not resolutions:
+        print("No images found for", pattern)
+        return None
+    resolution = collections.Counter(resolutions.values()).most_common(1)[0][0]
+    paths = [path for path, path_resolution in resolutions.items() if path_resolution == resolution]
+    print(f"Calibrating on {len(paths)} images of {resolution[0]}x{resolution[1]}")
+
+    calibration = calibrate_camera(paths)
+    if calibration is None:
+        return None
+    path = save_calibration(camera_id, calibration)
+    print(f"Calibrated on {int(calibration['views'])} views, reprojection error {float(calibration['rms']):.2f} px")
+    print("Camera matrix:\n", calibration["camera_matrix"])
+    print("Distortion coefficients:", calibration["dist_coeffs"])
+    print("Saved in", path)
+    return calibration
+
+if __name__ == "__main__":
+    main()
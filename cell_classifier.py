@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+
+# Because the grid is known, there is no need to search the whole frame for ellipses:
+# a small patch is sampled out of the middle of every cell (one remap for the whole board)
+# and the share of red and blue pixels in each patch decides what is on that cell.
+
+EMPTY, RED, BLUE = 0, 1, 2
+COLOR_NAMES = {RED: "red", BLUE: "blue"}
+
+COLOR_BOUNDS = {
+    "blue": [((100, 150, 50), (140, 255, 255))],
+    "red": [((0, 120, 70), (10, 255, 255)), ((170, 120, 70), (180, 255, 255))],
+}
+
+PATCH_SIZE = 8
+
+def cell_sample_maps(grid, patch_size=PATCH_SIZE, fill=0.6):
+    """
+    Remap tables that put a patch_size x patch_size sample of every cell next to each other,
+    so cell (row, column) ends up at [row * patch_size:(row + 1) * patch_size, column * patch_size:...].
+    fill is the part of the cell that is sampled, around its center.
+    """
+    size = grid.board_size
+    offsets = (np.arange(patch_size) + 0.5) / patch_size
+    offsets = 0.5 + (offsets - 0.5) * fill
+    positions = (np.arange(size)[:, np.newaxis] + offsets[np.newaxis, :]).reshape(-1)
+
+    columns, rows = np.meshgrid(positions, positions)
+    board_points = np.stack([columns, rows], axis=-1).reshape(-1, 2)
+    image_points = grid.board_to_image(board_points).reshape(size * patch_size, size * patch_size, 2)
+    return image_points[..., 0].astype(np.float32), image_points[..., 1].astype(np.float32)
+
+def sample_cells(img, maps, dst=None):
+    map_x, map_y = maps
+    return cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_REPLICATE)
+
+def color_masks(samples, color_bounds=COLOR_BOUNDS):
+    hsv = cv2.cvtColor(samples, cv2.COLOR_BGR2HSV)
+    masks = {}
+    for color, bounds in color_bounds.items():
+        mask = None
+        for lower, upper in bounds:
+            color_mask = cv2.inRange(hsv, np.array(lower), np.array(upper))
+            mask = color_mask if mask is None else cv2.bitwise_or(mask, color_mask)
+        masks[color] = mask
+    return masks
+
+def cell_occupancy(masks, board_size, patch_size=PATCH_SIZE):
+    """Share of the pixels of every color in every cell, as board_size x board_size arrays."""
+    return {color: mask.reshape(board_size, patch_size, board_size, patch_size).mean(axis=(1, 3)) / 255
+            for color, mask in masks.items()}
+
+def classify_cells(img, grid, maps=None, color_bounds=COLOR_BOUNDS, min_fraction=0.1, samples=None):
+    """
+    Label all cells at once. Returns an int8 array with board_size * board_size labels
+    (EMPTY, RED or BLUE) in row-major order. samples is an optional buffer for the sampled cells.
+    """
+    if maps is None:
+        maps = cell_sample_maps(grid)
+    patch_size = maps[0].shape[0] // grid.board_size
+
+    occupancy = cell_occupancy(color_masks(sample_cells(img, maps, samples), color_bounds), grid.board_size, patch_size)
+    red = occupancy.get("red", 0).reshape(-1)
+    blue = occupancy.get("blue", 0).reshape(-1)
+
+    labels = np.full(grid.board_size * grid.board_size, EMPTY, dtype=np.int8)
+    labels[(red >= min_fraction) & (red >= blue)] = RED
+    labels[(blue >= min_fraction) & (blue > red)] = BLUE
+    return labels
+
+def labels_to_pieces(labels, board_size):
+    """Same format as the ellipse path: a list of (color, (row, column))."""
+    return [(COLOR_NAMES[int(labels[index])], (int(index) // board_size, int(index) % board_size))
+            for index in np.flatnonzero(labels)]
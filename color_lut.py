@@ -0,0 +1,121 @@
+import glob
+import threading
+import time
+import cv2
+import numpy as np
+
+from cell_classifier import COLOR_BOUNDS
+from recognizer import FrameBuffers, Recognizer
+
+# Instead of converting the frame to HSV and running inRange once per range, every possible BGR value
+# is classified once in advance: a table with one byte per color (2^24 entries, 16 MB) in which bit i
+# is set when that color falls in the bounds of the i-th piece color. Labeling a frame is then a single
+# lookup per pixel, and because the table is built with the same cvtColor and inRange the masks are
+# identical to the ones of Recognizer.color_masks.
+# The pixel is read as a little endian uint32 of a BGRA copy: B + G << 8 + R << 16 (+ alpha << 24).
+# The table is only read, the scratch buffers (BGRA copy, indices, labels) are pooled per thread.
+
+_tables = {}
+
+def bounds_key(color_bounds):
+    return tuple((color, tuple((tuple(int(value) for value in lower), tuple(int(value) for value in upper))
+                               for lower, upper in bounds))
+                 for color, bounds in color_bounds.items())
+
+def build_color_table(color_bounds=COLOR_BOUNDS):
+    """The 2^24 entry table for color_bounds (bit i: the i-th color). Takes about half a second, built tables are kept."""
+    key = bounds_key(color_bounds)
+    table = _tables.get(key)
+    if table is not None:
+        return table
+
+    values = np.arange(1 << 24, dtype=np.uint32)
+    bgr = np.stack([values & 255, (values >> 8) & 255, values >> 16], axis=-1).astype(np.uint8)
+    del values
+    hsv = cv2.cvtColor(bgr.reshape(4096, 4096, 3), cv2.COLOR_BGR2HSV)
+    del bgr
+
+    table = np.zeros((4096, 4096), dtype=np.uint8)
+    for bit, (color, bounds) in enumerate(color_bounds.items()):
+        for lower, upper in bounds:
+            mask = cv2.inRange(hsv, np.array(lower, dtype=np.uint8), np.array(upper, dtype=np.uint8))
+            table[mask > 0] |= 1 << bit
+    table = table.reshape(-1)
+    _tables[key] = table
+    return table
+
+class ColorLUT:
+    """
+    Labels every pixel of a BGR image with one table lookup, see build_color_table.
+    Can be used by several threads at once: every thread gets its own pooled buffers.
+    """
+
+    def __init__(self, color_bounds=COLOR_BOUNDS):
+        self.colors = list(color_bounds)
+        self.codes = {color: 1 << bit for bit, color in enumerate(self.colors)}
+        self.table = build_color_table(color_bounds)
+        self.local = threading.local()
+
+    @property
+    def buffers(self):
+        """The FrameBuffers of the calling thread."""
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None:
+            buffers = self.local.buffers = FrameBuffers()
+        return buffers
+
+    def labels(self, img, dst=None):
+        """uint8 image with the bits of the colors of every pixel (0: background), in dst or in a pooled buffer."""
+        height, width = img.shape[:2]
+        buffers = self.buffers
+        bgra = buffers.get("bgra", (height, width, 4))
+        cv2.cvtColor(img, cv2.COLOR_BGR2BGRA, dst=bgra)
+        indices = buffers.get("indices", (height, width), np.uint32)
+        np.bitwise_and(bgra.view(np.uint32).reshape(height, width), 0xFFFFFF, out=indices)
+        if dst is None:
+            dst = buffers.get("labels", (height, width))
+        np.take(self.table, indices, out=dst)
+        return dst
+
+    def color_masks(self, img, masks=None):
+        """Same result as Recognizer.color_masks: one 0/255 mask per color, in masks or in pooled buffers."""
+        height, width = img.shape[:2]
+        labels = self.labels(img)
+        if masks is None:
+            masks = {color: self.buffers.get("mask " + color, (height, width)) for color in self.colors}
+        for color, code in self.codes.items():
+            cv2.bitwise_and(labels, code, dst=masks[color])
+            cv2.compare(masks[color], 0, cv2.CMP_GT, dst=masks[color])
+        return masks
+
+def main(pattern='./test_images/images_with_pieces/*.jpg', repeat=5):
+    """Compare the table lookup with cvtColor + inRange on the test images: identical masks, and the time per frame."""
+    recognizer = Recognizer(verbose=False)
+    start = time.perf_counter()
+    lut_recognizer = Recognizer(verbose=False, color_classifier="lut")
+    print(f"table built in {1000 * (time.perf_counter() - start):.0f} ms")
+
+    inrange_times = []
+    lut_times = []
+    for path_board in sorted(glob.glob(pattern)):
+        if "_processed" in path_board:
+            continue
+        img = cv2.imread(path_board)
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            expected = recognizer.color_masks(img)
+            inrange_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            masks = lut_recognizer.color_masks(img)
+            lut_times.append(time.perf_counter() - start)
+
+        different = sum(int(np.count_nonzero(masks[color] != expected[color])) for color in expected)
+        print(f"{path_board}: {img.shape[1]}x{img.shape[0]}, {different} pixels differ")
+
+    print(f"cvtColor + inRange: {1000 * np.median(inrange_times):.1f} ms, "
+          f"lookup table: {1000 * np.median(lut_times):.1f} ms per frame (median)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import datetime
+import glob
+import json
+import os
+
+from cell_classifier import COLOR_BOUNDS
+
+# The HSV bounds of the pieces depend on the pieces, the board and the light. calibrate_color saves
+# them as a named profile (one JSON file per setup in color_profiles/) and the recognition loads the
+# profile at startup, so another light only needs another profile name:
+#   COLOR_PROFILE in the recognition modules, else the environment variable COLOR_PROFILE.
+# Without a profile the built-in COLOR_BOUNDS of cell_classifier are used.
+
+PROFILE_DIR = "color_profiles"
+PROFILE_VARIABLE = "COLOR_PROFILE"
+
+def get_profile_path(name, profile_dir=PROFILE_DIR):
+    return os.path.join(profile_dir, f"{name}.json")
+
+def list_profiles(profile_dir=PROFILE_DIR):
+    return sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(profile_dir, "*.json")))
+
+def hue_ranges(lower, upper):
+    """
+    One HSV range, or two when the hue goes around the end of OpenCV's 0..179 hue circle
+    (red: a calibrated hue of 2 +- 5 becomes 0..7 and 177..179).
+    """
+    lower = [int(value) for value in lower]
+    upper = [int(value) for value in upper]
+    lower[1:] = [max(0, value) for value in lower[1:]]
+    upper[1:] = [min(255, value) for value in upper[1:]]
+    if lower[0] < 0:
+        return [((0, *lower[1:]), tuple(upper)), ((180 + lower[0], *lower[1:]), (179, *upper[1:]))]
+    if upper[0] > 179:
+        return [(tuple(lower), (179, *upper[1:])), ((0, *lower[1:]), (upper[0] - 180, *upper[1:]))]
+    return [(tuple(lower), tuple(upper))]
+
+def save_profile(name, color_bounds, board=None, lighting=None, profile_dir=PROFILE_DIR):
+    """color_bounds: {color: [(lower HSV, upper HSV), ...]}, like COLOR_BOUNDS. Returns the path of the profile."""
+    os.makedirs(profile_dir, exist_ok=True)
+    profile = {
+        "name": name,
+        "saved": datetime.datetime.now().isoformat(),
+        "board": board,
+        "lighting": lighting,
+        "colors": {color: [[[int(value) for value in lower], [int(value) for value in upper]] for lower, upper in bounds]
+                   for color, bounds in color_bounds.items()},
+    }
+    path = get_profile_path(name, profile_dir)
+    with open(path, 'w') as json_file:
+        json.dump(profile, json_file, indent=4)
+    return path
+
+def read_profile(name, profile_dir=PROFILE_DIR):
+    """The whole profile as it is stored. Raises FileNotFoundError for an unknown profile."""
+    with open(get_profile_path(name, profile_dir)) as json_file:
+        return json.load(json_file)
+
+def load_profile(name, profile_dir=PROFILE_DIR):
+    """The color bounds of a profile, in the format of COLOR_BOUNDS. Raises FileNotFoundError for an unknown profile."""
+    profile = read_profile(name, profile_dir)
+    return {color: [(tuple(lower), tuple(upper)) for lower, upper in bounds] for color, bounds in profile["colors"].items()}
+
+def update_profile(name, color, bounds, board=None, lighting=None, profile_dir=PROFILE_DIR):
+    """
+    Replace the bounds of one color in a profile (created from COLOR_BOUNDS when it does not exist yet).
+    board and lighting keep their stored value when they are None.
+    """
+    try:
+        profile = read_profile(name, profile_dir)
+        color_bounds = load_profile(name, profile_dir)
+        board = board if board is not None else profile.get("board")
+        lighting = lighting if lighting is not None else profile.get("lighting")
+    except FileNotFoundError:
+        color_bounds = dict(COLOR_BOUNDS)
+    color_bounds[color] = bounds
+    return save_profile(name, color_bounds, board, lighting, profile_dir)
+
+def load_color_bounds(name=None, profile_dir=PROFILE_DIR):
+    """
+    The color bounds to recognize with: the profile name, else the profile of the environment variable
+    COLOR_PROFILE, else COLOR_BOUNDS. A missing profile falls back to COLOR_BOUNDS with a warning.
+    """
+    name = name or os.environ.get(PROFILE_VARIABLE)
+    if not name:
+        return COLOR_BOUNDS
+    try:
+        color_bounds = load_profile(name, profile_dir)
+    except FileNotFoundError:
+        print(f"Color profile '{name}' not found in {profile_dir}/, using the default colors")
+        return COLOR_BOUNDS
+    print(f"Using color profile '{name}'")
+    return color_bounds
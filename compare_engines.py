@@ -0,0 +1,57 @@
+import glob
+import time
+import cv2
+import numpy as np
+
+import recognition
+from corner_detection import find_corners_in_photo, photo_cascade
+from recognizer import Recognizer
+from cell_classifier import cell_sample_maps, classify_cells, labels_to_pieces
+
+# Runs the ellipse path and the per-cell classifier on the test images and compares speed and results.
+
+def main():
+    number_of_corners = (recognition.corners_to_be_found, recognition.corners_to_be_found)
+    ellipse_times = []
+    cell_times = []
+    agreements = []
+    cascade = photo_cascade(number_of_corners)
+
+    for path_board in sorted(glob.glob('./test_images/images_with_pieces/*.jpg')):
+        if "_processed" in path_board:
+            continue
+
+        img = cv2.imread(path_board)
+        gray = cv2.medianBlur(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 13)
+        corners = find_corners_in_photo(gray, number_of_corners, cascade)
+        if corners is None:
+            print("No chessboard detected", path_board)
+            continue
+
+        recognizer = Recognizer(recognition.BOARD_SIZE, verbose=False)
+        recognizer.set_corners(corners)
+        grid = recognizer.grid
+
+        start = time.perf_counter()
+        ellipse_pieces = set(recognizer.recognize(img, engine="ellipses")["pieces"])
+        ellipse_times.append(time.perf_counter() - start)
+
+        # the sample maps only change when the board moves, so they are not part of the time per frame
+        maps = cell_sample_maps(grid)
+        start = time.perf_counter()
+        cell_pieces = set(labels_to_pieces(classify_cells(img, grid, maps), recognition.BOARD_SIZE))
+        cell_times.append(time.perf_counter() - start)
+
+        union = ellipse_pieces | cell_pieces
+        agreement = len(ellipse_pieces & cell_pieces) / len(union) if union else 1.0
+        agreements.append(agreement)
+        print(f"{path_board}: ellipses {len(ellipse_pieces)} pieces in {1000 * ellipse_times[-1]:.1f} ms, "
+              f"cells {len(cell_pieces)} pieces in {1000 * cell_times[-1]:.1f} ms, agreement {agreement:.0%}")
+
+    if not agreements:
+        return
+    print(f"ellipses: {1000 * np.mean(ellipse_times):.1f} ms per image, cells: {1000 * np.mean(cell_times):.1f} ms per image, "
+          f"{np.mean(ellipse_times) / np.mean(cell_times):.0f}x faster, average agreement {np.mean(agreements):.0%}")
+
+if __name__ == "__main__":
+    main()
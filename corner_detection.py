@@ -0,0 +1,272 @@
+import glob
+import time
+import cv2
+import numpy as np
+
+from instrumentation import count, stage
+
+# findChessboardCornersSB gets a lot slower on big images, while the test photos are several megapixels.
+# The coarse to fine search looks for the board on a downscaled copy and only goes back to
+# full resolution for cornerSubPix, in a crop around the board.
+# DetectionCascade puts the detectors in order from cheap to expensive and keeps statistics per tier.
+
+MAX_SEARCH_SIZE = 1280
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+SEED_MAX_SHIFT = 5.0
+SEED_MAX_DEFORMATION = 1.0
+SEED_MIN_RESPONSE = 2.0 # median corner response (gray levels per pixel) of a seed that still lies on the board
+CORNER_WINDOW = 13
+CASCADE_ORDER = ("seed", "coarse", "coarse exhaustive", "exhaustive", "classic")
+PHOTO_ORDER = tuple(tier for tier in CASCADE_ORDER if tier != "seed") # unrelated photos: the previous one is no seed
+
+def find_corners_full(gray, number_of_corners, flags=cv2.CALIB_CB_EXHAUSTIVE):
+    """The original search: the whole image at full resolution, then cornerSubPix."""
+    with stage("findChessboardCornersSB"):
+        ret, corners = cv2.findChessboardCornersSB(gray, number_of_corners, flags=flags)
+    if not ret:
+        return None
+    with stage("cornerSubPix"):
+        return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria=SUBPIX_CRITERIA)
+
+def board_bounding_box(corners, image_shape, margin):
+    x, y, width, height = cv2.boundingRect(np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2))
+    image_height, image_width = image_shape[:2]
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(image_width, x + width + margin), min(image_height, y + height + margin)
+    return x0, y0, x1, y1
+
+def find_corners_coarse(gray, number_of_corners, flags=cv2.CALIB_CB_EXHAUSTIVE, max_search_size=MAX_SEARCH_SIZE):
+    """
+    Search the board on a copy of gray that is at most max_search_size pixels wide or high.
+    Returns the (not yet refined) corners in full resolution coordinates or None.
+    """
+    height, width = gray.shape[:2]
+    scale = min(1.0, max_search_size / max(height, width))
+    if scale == 1.0:
+        with stage("findChessboardCornersSB"):
+            ret, corners = cv2.findChessboardCornersSB(gray, number_of_corners, flags=flags)
+        return corners if ret else None
+
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    with stage("findChessboardCornersSB downscaled"):
+        ret, corners = cv2.findChessboardCornersSB(small, number_of_corners, flags=flags)
+    if not ret:
+        return None
+
+    # pixel centers: pixel i of the small image covers pixels i / scale .. (i + 1) / scale
+    return ((corners + 0.5) / scale - 0.5).astype(np.float32)
+
+def refine_corners(gray, corners):
+    """cornerSubPix on the full resolution crop around the board instead of on the whole image."""
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2)
+
+    # one cell of margin, so the subpixel windows of the outer corners fit in the crop
+    spacing = np.linalg.norm(corners[1, 0] - corners[0, 0])
+    x0, y0, x1, y1 = board_bounding_box(corners, gray.shape, int(np.ceil(spacing)))
+    roi = gray[y0:y1, x0:x1]
+
+    offset = np.array([x0, y0], dtype=np.float32)
+    with stage("cornerSubPix"):
+        corners = cv2.cornerSubPix(roi, corners - offset, (11, 11), (-1, -1), criteria=SUBPIX_CRITERIA)
+    return corners + offset
+
+def find_corners_coarse_to_fine(gray, number_of_corners, flags=cv2.CALIB_CB_EXHAUSTIVE, max_search_size=MAX_SEARCH_SIZE):
+    """
+    Search the board on a copy of gray that is at most max_search_size pixels wide or high,
+    then refine the corners with cornerSubPix on the full resolution crop around the board.
+    Returns the corners in full resolution coordinates (same shape as findChessboardCornersSB) or None.
+    """
+    height, width = gray.shape[:2]
+    if max_search_size >= max(height, width):
+        return find_corners_full(gray, number_of_corners, flags)
+
+    corners = find_corners_coarse(gray, number_of_corners, flags, max_search_size)
+    if corners is None:
+        return None
+    return refine_corners(gray, corners)
+
+def corner_response(gray, corners, window=CORNER_WINDOW):
+    """
+    Per corner the smaller eigenvalue of the structure tensor of the window around it (as a gradient in gray
+    levels per pixel): high where edges in two directions cross, about 0 on an edge, a flat area or a blur.
+    """
+    height, width = gray.shape[:2]
+    points = np.rint(np.asarray(corners).reshape(-1, 2)).astype(int)
+    offsets = np.arange(window) - window // 2
+    rows = np.clip(points[:, 1, np.newaxis] + offsets, 0, height - 1)
+    columns = np.clip(points[:, 0, np.newaxis] + offsets, 0, width - 1)
+    patches = gray[rows[:, :, np.newaxis], columns[:, np.newaxis, :]].astype(np.float32)
+    gradient_x = np.diff(patches, axis=2)[:, :-1, :]
+    gradient_y = np.diff(patches, axis=1)[:, :, :-1]
+    xx = (gradient_x * gradient_x).mean(axis=(1, 2))
+    xy = (gradient_x * gradient_y).mean(axis=(1, 2))
+    yy = (gradient_y * gradient_y).mean(axis=(1, 2))
+    smallest = (xx + yy) / 2 - np.sqrt(((xx - yy) / 2) ** 2 + xy * xy)
+    return np.sqrt(np.maximum(smallest, 0))
+
+def find_corners_from_seed(gray, number_of_corners, seed):
+    """
+    Refine the corners of the previous detection on the new frame. Only accepted when all corners
+    moved (almost) the same way: a board that is still or slid a little, not one that moved away.
+    """
+    if seed is None:
+        return None
+    seed = np.asarray(seed, dtype=np.float32).reshape(-1, 1, 2)
+    if len(seed) != number_of_corners[0] * number_of_corners[1]:
+        return None
+    height, width = gray.shape[:2]
+    points = seed.reshape(-1, 2)
+    if points.min() < 0 or (points[:, 0] >= width).any() or (points[:, 1] >= height).any():
+        # another resolution, or the board was at the edge: cornerSubPix refuses corners outside the image
+        return None
+
+    with stage("cornerSubPix seed"):
+        corners = cv2.cornerSubPix(gray, seed.copy(), (11, 11), (-1, -1), criteria=SUBPIX_CRITERIA)
+    shifts = (corners - seed).reshape(-1, 2)
+    common_shift = np.median(shifts, axis=0)
+    if np.linalg.norm(common_shift) > SEED_MAX_SHIFT:
+        return None
+    if np.linalg.norm(shifts - common_shift, axis=1).max() > SEED_MAX_DEFORMATION:
+        return None
+    # without gradients (no board, a blank or covered view) cornerSubPix leaves every corner where it was,
+    # which looks like a board that did not move: the refined corners have to be corners of the image
+    if np.median(corner_response(gray, corners)) < SEED_MIN_RESPONSE:
+        return None
+    return corners
+
+def find_corners_classic(gray, number_of_corners):
+    """The old fallback of the built-in version: findChessboardCorners with a fast check."""
+    with stage("findChessboardCorners"):
+        ret, corners = cv2.findChessboardCorners(gray, number_of_corners, flags=cv2.CALIB_CB_PLAIN + cv2.CALIB_CB_FAST_CHECK)
+    if not ret:
+        return None
+    with stage("cornerSubPix"):
+        return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria=SUBPIX_CRITERIA)
+
+def normalize_corner_order(corners, number_of_corners):
+    """
+    Different detectors can start counting at another corner of the board. Put the corners in the
+    same order every time: rows from top to bottom, and every row from left to right.
+    """
+    rows, columns = number_of_corners[1], number_of_corners[0]
+    grid = np.asarray(corners, dtype=np.float32).reshape(rows, columns, 2)
+    row_direction = grid[0, -1] - grid[0, 0]
+    column_direction = grid[-1, 0] - grid[0, 0]
+    if rows == columns and abs(row_direction[1]) > abs(row_direction[0]):
+        # the rows run vertically in the image: swap rows and columns
+        grid = grid.transpose(1, 0, 2)
+        row_direction, column_direction = column_direction, row_direction
+    if row_direction[0] < 0:
+        grid = grid[:, ::-1]
+    if column_direction[1] < 0:
+        grid = grid[::-1]
+    return np.ascontiguousarray(grid).reshape(-1, 1, 2)
+
+CASCADE_TIERS = {
+    "seed": find_corners_from_seed,
+    "coarse": lambda gray, number_of_corners, seed: find_corners_coarse_to_fine(gray, number_of_corners, flags=0),
+    "coarse exhaustive": lambda gray, number_of_corners, seed: find_corners_coarse_to_fine(gray, number_of_corners),
+    "exhaustive": lambda gray, number_of_corners, seed: find_corners_full(gray, number_of_corners, cv2.CALIB_CB_EXHAUSTIVE + cv2.CALIB_CB_ACCURACY),
+    "classic": lambda gray, number_of_corners, seed: find_corners_classic(gray, number_of_corners),
+}
+
+class DetectionCascade:
+    """
+    Runs the detectors of CASCADE_TIERS in the given order and stops at the first one that finds the board.
+    The corners of the last detection are the seed for the next frame. Per tier the number of attempts,
+    hits and the time spent are counted, so the order can be tuned on real data.
+    """
+
+    def __init__(self, number_of_corners, order=CASCADE_ORDER, tiers=CASCADE_TIERS):
+        self.number_of_corners = number_of_corners
+        self.tiers = [(name, tiers[name]) for name in order]
+        self.last_corners = None
+        self.stats = {name: {"attempts": 0, "hits": 0, "seconds": 0.0} for name in order}
+
+    def detect(self, gray):
+        for name, detector in self.tiers:
+            if name == "seed" and self.last_corners is None:
+                continue
+            start = time.perf_counter()
+            corners = detector(gray, self.number_of_corners, self.last_corners)
+            stats = self.stats[name]
+            stats["attempts"] += 1
+            stats["seconds"] += time.perf_counter() - start
+            if corners is not None:
+                stats["hits"] += 1
+                count(f"cascade {name} hits")
+                corners = normalize_corner_order(corners, self.number_of_corners)
+                self.last_corners = corners
+                return corners
+        count("cascade misses")
+        return None
+
+    def report(self):
+        for name, stats in self.stats.items():
+            if stats["attempts"] == 0:
+                print(f"{name}: not used")
+                continue
+            print(f"{name}: {stats['hits']} of {stats['attempts']} hits ({stats['hits'] / stats['attempts']:.0%}), "
+                  f"{1000 * stats['seconds'] / stats['attempts']:.0f} ms per attempt")
+
+def photo_cascade(number_of_corners):
+    """The cascade for unrelated photos (test images, calibration shots): every tier except the seed."""
+    return DetectionCascade(number_of_corners, order=PHOTO_ORDER)
+
+def find_corners_in_photo(gray, number_of_corners, cascade=None):
+    """
+    The corners of one photo (gray: gray and median blurred, like Recognizer.prepare_gray), the same way for
+    every script that works on still images. Pass the cascade of photo_cascade to keep statistics over photos.
+    """
+    if cascade is None:
+        cascade = photo_cascade(number_of_corners)
+    return cascade.detect(gray)
+
+def main(pattern='./test_images/images_with_pieces/*.jpg'):
+    """
+    Compare the coarse to fine search with the full resolution search on the test images,
+    then show how often every tier of the cascade finds the board.
+    """
+    corners_to_be_found = 14
+    number_of_corners = (corners_to_be_found, corners_to_be_found)
+    full_times = []
+    coarse_times = []
+    deltas = []
+    cascade = photo_cascade(number_of_corners)
+
+    for path_board in sorted(glob.glob(pattern)):
+        if "_processed" in path_board:
+            continue
+        img = cv2.imread(path_board)
+        gray = cv2.medianBlur(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 13)
+
+        start = time.perf_counter()
+        full = find_corners_full(gray, number_of_corners)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        coarse = find_corners_coarse_to_fine(gray, number_of_corners)
+        coarse_time = time.perf_counter() - start
+
+        find_corners_in_photo(gray, number_of_corners, cascade)
+
+        if full is None or coarse is None:
+            print(f"{path_board}: full {'found' if full is not None else 'not found'}, "
+                  f"coarse to fine {'found' if coarse is not None else 'not found'}")
+            continue
+
+        delta = np.linalg.norm(full.reshape(-1, 2) - coarse.reshape(-1, 2), axis=1)
+        full_times.append(full_time)
+        coarse_times.append(coarse_time)
+        deltas.append(delta)
+        print(f"{path_board}: full {1000 * full_time:.0f} ms, coarse to fine {1000 * coarse_time:.0f} ms "
+              f"({full_time / coarse_time:.1f}x), corner difference mean {delta.mean():.2f} px, max {delta.max():.2f} px")
+
+    if full_times:
+        deltas = np.concatenate(deltas)
+        print(f"speedup {sum(full_times) / sum(coarse_times):.1f}x, corner difference mean {deltas.mean():.2f} px, "
+              f"95th percentile {np.percentile(deltas, 95):.2f} px, max {deltas.max():.2f} px")
+    cascade.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import time
+import cv2
+import numpy as np
+
+from instrumentation import timed
+
+# kmeans with 4 clusters, 10 attempts and 200 iterations on every pixel of a full HD frame
+# freezes the preview of the calibration for seconds. DominantColorEstimator only looks at a few
+# thousand pixels per frame (every n-th pixel, optionally inside a ROI or a mask of the piece cells)
+# and keeps a slowly fading HSV histogram of them. The dominant color is the peak of that histogram,
+# refined with the mean of the pixels around the peak, so every frame costs about a millisecond
+# and the estimate gets steadier with every frame while the preview keeps running.
+
+MAX_SAMPLES = 4000
+HISTOGRAM_BINS = (30, 16, 16) # hue (6 hue units per bin, the sensitivity of the bounds is 5), saturation, value
+MIN_SATURATION = 50 # the black and white squares are not a piece color, the bounds start at 50 as well
+DECAY = 0.9 # share of the histogram that is kept per frame
+SMOOTHING = 0.3 # weight of the newest frame in the refined estimate
+
+def sample_pixels(frame, roi=None, mask=None, max_samples=MAX_SAMPLES):
+    """
+    About max_samples pixels of frame (every n-th row and column), only inside roi (x, y, width, height)
+    and where mask is not 0 when they are given. Returns an N x 3 array.
+    """
+    if roi is not None:
+        x, y, width, height = roi
+        frame = frame[y:y + height, x:x + width]
+        if mask is not None:
+            mask = mask[y:y + height, x:x + width]
+    height, width = frame.shape[:2]
+    if mask is not None:
+        # the share of the frame that is in the mask, measured on a coarse grid
+        coarse = mask[::max(1, height // 64), ::max(1, width // 64)]
+        area = max(1.0, height * width * np.count_nonzero(coarse) / max(1, coarse.size))
+    else:
+        area = height * width
+    step = max(1, int(np.sqrt(area / max_samples)))
+    pixels = frame[::step, ::step]
+    if mask is not None:
+        return pixels[mask[::step, ::step] > 0]
+    return pixels.reshape(-1, frame.shape[2])
+
+def cells_mask(grid, image_shape, cells, fill=0.6):
+    """Mask of the middle of the given cells ((row, column), e.g. the cells of the recognized pieces)."""
+    mask = np.zeros(image_shape[:2], dtype=np.uint8)
+    offsets = 0.5 + (np.array([[0, 0], [1, 0], [1, 1], [0, 1]]) - 0.5) * fill
+    for row, column in cells:
+        outline = grid.board_to_image(offsets + (column, row))
+        cv2.fillConvexPoly(mask, np.round(outline).astype(np.int32), 255)
+    return mask
+
+def circular_mean_hue(hues, weights=None):
+    angles = hues.astype(np.float64) * (2 * np.pi / 180)
+    angle = np.arctan2(np.average(np.sin(angles), weights=weights), np.average(np.cos(angles), weights=weights))
+    return (angle * 180 / (2 * np.pi)) % 180
+
+class DominantColorEstimator:
+    """
+    Running estimate of the dominant (saturated) color of the frames it is given.
+    update() once per frame, dominant_hsv() or dominant_bgr() whenever the estimate is needed.
+    """
+
+    def __init__(self, max_samples=MAX_SAMPLES, bins=HISTOGRAM_BINS, min_saturation=MIN_SATURATION,
+                 decay=DECAY, smoothing=SMOOTHING):
+        self.max_samples = max_samples
+        self.bins = bins
+        self.min_saturation = min_saturation
+        self.decay = decay
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.histogram = np.zeros(self.bins, dtype=np.float32)
+        self.peak = None
+        self.estimate = None
+        self.frames = 0
+        self.seconds = 0.0
+
+    @timed("DominantColorEstimator.update")
+    def update(self, frame, roi=None, mask=None):
+        """Add the samples of one BGR frame. Returns the new estimate (HSV) or None when nothing usable was seen yet."""
+        start = time.perf_counter()
+        pixels = sample_pixels(frame, roi, mask, self.max_samples)
+        self.frames += 1
+        if len(pixels) == 0:
+            return self.dominant_hsv()
+        hsv = cv2.cvtColor(pixels.reshape(-1, 1, 3), cv2.COLOR_BGR2HSV).reshape(-1, 3)
+        hsv = hsv[hsv[:, 1] >= self.min_saturation]
+        if len(hsv) > 0:
+            self.histogram *= self.decay
+            self.histogram += cv2.calcHist([hsv.reshape(-1, 1, 3)], [0, 1, 2], None, list(self.bins),
+                                           [0, 180, 0, 256, 0, 256])
+            self.refine(hsv)
+        self.seconds += time.perf_counter() - start
+        return self.dominant_hsv()
+
+    def refine(self, hsv):
+        """Mean of the pixels of this frame in the peak bin and its neighbours, blended into the estimate."""
+        peak = np.unravel_index(int(np.argmax(self.histogram)), self.bins)
+        widths = 180 / self.bins[0], 256 / self.bins[1], 256 / self.bins[2]
+        hue_bins = (hsv[:, 0] / widths[0]).astype(int)
+        hue_distance = np.minimum((hue_bins - peak[0]) % self.bins[0], (peak[0] - hue_bins) % self.bins[0])
+        near = ((hue_distance <= 1)
+                & (np.abs((hsv[:, 1] / widths[1]).astype(int) - peak[1]) <= 1)
+                & (np.abs((hsv[:, 2] / widths[2]).astype(int) - peak[2]) <= 1))
+        if not near.any():
+            return
+        near_pixels = hsv[near]
+        mean = np.array([circular_mean_hue(near_pixels[:, 0]), near_pixels[:, 1].mean(), near_pixels[:, 2].mean()])
+
+        if self.estimate is None or peak != self.peak:
+            # another color became the most common one: start over instead of blending two colors
+            self.estimate = mean
+        else:
+            hue_step = (mean[0] - self.estimate[0] + 90) % 180 - 90
+            self.estimate = self.estimate + self.smoothing * np.array([hue_step, mean[1] - self.estimate[1],
+                                                                       mean[2] - self.estimate[2]])
+            self.estimate[0] %= 180
+        self.peak = peak
+
+    def dominant_hsv(self):
+        """The dominant color as HSV ints (a plain array, so hue - sensitivity does not wrap around), or None."""
+        if self.estimate is None:
+            return None
+        return np.round(self.estimate).astype(int) % np.array([180, 256, 256])
+
+    def dominant_bgr(self):
+        hsv = self.dominant_hsv()
+        if hsv is None:
+            return None
+        return cv2.cvtColor(np.uint8([[hsv]]), cv2.COLOR_HSV2BGR)[0][0]
+
+    def report(self):
+        if self.frames:
+            print(f"{self.frames} frames, {1000 * self.seconds / self.frames:.1f} ms per frame, estimate (HSV): {self.dominant_hsv()}")
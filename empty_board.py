@@ -0,0 +1,113 @@
+import cv2
+import numpy as np
+
+from cell_classifier import COLOR_BOUNDS, COLOR_NAMES, EMPTY, PATCH_SIZE, cell_sample_maps, color_masks
+from instrumentation import timed
+
+# Instead of asking every pixel whether it is "red enough" or "blue enough", the empty board is
+# captured once after the grid is known: a patch out of the middle of every cell (the same remap as the
+# cells engine), stored in Lab. A cell is occupied when enough pixels of its patch differ from that
+# reference. The HSV bounds are then only needed to tell red from blue on the occupied cells.
+# The whole board is one 120 x 120 image, so this is a single vectorized pass without contours.
+# A change of the light moves all pixels the same way: the median difference over the board is
+# subtracted first, and the reference of the empty cells follows slow changes with a small learning rate.
+
+DEVIATION_THRESHOLD = 20.0 # Lab distance of a pixel that does not look like the empty board any more
+MIN_FRACTION = 0.1 # share of the patch that has to deviate for an occupied cell
+ADAPTATION = 0.02 # weight of the newest frame in the reference of the cells that are empty
+
+COLOR_CODES = {name: code for code, name in COLOR_NAMES.items()}
+
+class EmptyBoardModel:
+    """
+    Reference of the empty board for one grid (for a fixed camera, or for the rectified image whose grid
+    never changes). capture() one or more frames of the empty board, then classify() every frame.
+    """
+
+    def __init__(self, grid, color_bounds=COLOR_BOUNDS, patch_size=PATCH_SIZE, threshold=DEVIATION_THRESHOLD,
+                 min_fraction=MIN_FRACTION, adaptation=ADAPTATION):
+        self.grid = grid
+        self.board_size = grid.board_size
+        self.color_bounds = color_bounds
+        self.patch_size = patch_size
+        self.threshold = threshold
+        self.min_fraction = min_fraction
+        self.adaptation = adaptation
+        self.maps = cell_sample_maps(grid, patch_size)
+
+        self.reference = None
+        self.frames_captured = 0
+        self.deviation = None
+        self.occupancy = None
+
+    def sample(self, img):
+        """The patches of all cells next to each other, as BGR and as float Lab."""
+        map_x, map_y = self.maps
+        samples = cv2.remap(img, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        lab = cv2.cvtColor(samples.astype(np.float32) / 255, cv2.COLOR_BGR2Lab)
+        return samples, lab
+
+    def per_cell(self, image):
+        """board_size x board_size mean of every patch of a (board_size * patch_size)^2 image."""
+        size, patch = self.board_size, self.patch_size
+        return image.reshape(size, patch, size, patch, *image.shape[2:]).mean(axis=(1, 3))
+
+    def captured(self):
+        return self.reference is not None
+
+    def capture(self, img):
+        """Add a frame of the empty board to the reference (the mean of all captured frames)."""
+        _, lab = self.sample(img)
+        self.frames_captured += 1
+        if self.reference is None:
+            self.reference = lab
+        else:
+            self.reference += (lab - self.reference) / self.frames_captured
+
+    @timed("EmptyBoardModel.classify")
+    def classify(self, img, adapt=True):
+        """
+        Label all cells (EMPTY, RED or BLUE in row-major order, int8 like classify_cells).
+        With adapt=True the reference of the empty cells moves a little towards this frame.
+        """
+        if self.reference is None:
+            raise ValueError("The empty board has not been captured yet, call capture first.")
+        samples, lab = self.sample(img)
+
+        difference = lab - self.reference
+        # the same change everywhere is the light, not a piece (most cells are empty)
+        difference -= np.median(difference.reshape(-1, 3), axis=0)
+        self.deviation = np.sqrt(np.einsum("ijk,ijk->ij", difference, difference))
+        deviating = self.deviation > self.threshold
+        self.occupancy = self.per_cell(deviating.astype(np.float32))
+        occupied = self.occupancy >= self.min_fraction
+
+        labels = np.full((self.board_size, self.board_size), EMPTY, dtype=np.int8)
+        if occupied.any():
+            labels[occupied] = self.piece_colors(samples, deviating)[occupied]
+
+        if adapt:
+            empty = np.repeat(np.repeat(~occupied, self.patch_size, axis=0), self.patch_size, axis=1)
+            self.reference[empty] += self.adaptation * (lab[empty] - self.reference[empty])
+        return labels.reshape(-1)
+
+    def piece_colors(self, samples, deviating):
+        """Per cell the piece color with the most deviating pixels inside its HSV bounds, else the closest hue."""
+        size = self.board_size
+        codes = [COLOR_CODES[color] for color in self.color_bounds]
+        shares = np.stack([self.per_cell(((mask > 0) & deviating).astype(np.float32))
+                           for mask in color_masks(samples, self.color_bounds).values()])
+
+        # cells whose pixels fall outside all bounds (other light): the hue of the deviating pixels decides
+        weights = self.per_cell(deviating.astype(np.float32)) + 1e-6
+        mean_bgr = self.per_cell(samples.astype(np.float32) * deviating[..., np.newaxis]) / weights[..., np.newaxis]
+        hues = cv2.cvtColor(mean_bgr.astype(np.uint8).reshape(size, size, 3), cv2.COLOR_BGR2HSV)[..., 0].astype(int)
+        hue_distances = []
+        for bounds in self.color_bounds.values():
+            centers = [(int(lower[0]) + int(upper[0])) // 2 for lower, upper in bounds]
+            distances = [np.minimum((hues - center) % 180, (center - hues) % 180) for center in centers]
+            hue_distances.append(np.min(distances, axis=0))
+        closest = np.argmin(hue_distances, axis=0)
+
+        best = np.where(shares.max(axis=0) > 0, np.argmax(shares, axis=0), closest)
+        return np.array(codes, dtype=np.int8)[best]
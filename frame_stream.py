@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from collections import deque
+import cv2
+
+# A blocking read -> process -> waitKey loop lets the driver buffer fill up while a frame is
+# being processed, so the board state lags further and further behind the real board.
+# Here a separate thread keeps reading the camera and only the newest frames are kept.
+
+def put_drop_oldest(frame_queue, item):
+    """Put an item in a bounded queue, throwing away the oldest item when the queue is full."""
+    while True:
+        try:
+            frame_queue.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                frame_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+def get_freshest(frame_queue, timeout=None):
+    """Block until there is a frame, then skip everything except the newest one."""
+    item = frame_queue.get(timeout=timeout)
+    while True:
+        try:
+            item = frame_queue.get_nowait()
+        except queue.Empty:
+            return item
+
+class FrameGrabber(threading.Thread):
+    def __init__(self, camera_id=1, queue_size=2, capture=None):
+        super().__init__(daemon=True)
+        self.camera_id = camera_id
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.capture = capture
+        self.frames_captured = 0
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if self.capture is None:
+            self.capture = cv2.VideoCapture(self.camera_id)
+            # keep the driver from buffering old frames for us
+            self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        if not self.capture.isOpened():
+            self.error = "Could not open the webcam."
+            self.stop()
+            return
+
+        while not self._stop_event.is_set():
+            ret, frame = self.capture.read()
+            if not ret:
+                self.error = "Could not read frame."
+                break
+            self.frames_captured += 1
+            put_drop_oldest(self.frames, (self.frames_captured, time.perf_counter(), frame))
+
+        self.capture.release()
+        self._stop_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def read(self, timeout=1.0):
+        """Returns (frame number, capture time, frame) of the newest frame, or None when nothing arrived in time."""
+        try:
+            return get_freshest(self.frames, timeout=timeout)
+        except queue.Empty:
+            return None
+
+class StreamStats:
+    def __init__(self, window=30):
+        self.latencies = deque(maxlen=window)
+        self.finish_times = deque(maxlen=window)
+        self.frames_processed = 0
+
+    def add(self, capture_time, finish_time=None):
+        if finish_time is None:
+            finish_time = time.perf_counter()
+        self.latencies.append(finish_time - capture_time)
+        self.finish_times.append(finish_time)
+        self.frames_processed += 1
+
+    def fps(self):
+        if len(self.finish_times) < 2:
+            return 0.0
+        elapsed = self.finish_times[-1] - self.finish_times[0]
+        return (len(self.finish_times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def latency_ms(self):
+        if not self.latencies:
+            return 0.0
+        return 1000 * sum(self.latencies) / len(self.latencies)
+
+def run_stream(process_frame, camera_id=1, queue_size=2, report_every=30, capture=None):
+    """
+    Let process_frame(frame) handle the newest camera frame over and over until it returns False
+    or the camera stops. Latency (capture until the end of process_frame) and fps are printed
+    every report_every frames. Returns the StreamStats.
+    """
+    grabber = FrameGrabber(camera_id, queue_size=queue_size, capture=capture)
+    grabber.start()
+    stats = StreamStats()
+
+    try:
+        while not grabber.stopped() or not grabber.frames.empty():
+            item = grabber.read()
+            if item is None:
+                continue
+            frame_number, capture_time, frame = item
+
+            keep_going = process_frame(frame)
+            stats.add(capture_time)
+
+            if report_every and stats.frames_processed % report_every == 0:
+                print(f"frame {frame_number}: {stats.fps():.1f} fps, latency {stats.latency_ms():.0f} ms, "
+                      f"{grabber.frames_captured - stats.frames_processed} of {grabber.frames_captured} frames skipped")
+
+            if keep_going is False:
+                break
+    finally:
+        grabber.stop()
+        grabber.join(timeout=2)
+
+    if grabber.error:
+        print("Error:", grabber.error)
+    return stats
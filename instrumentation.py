@@ -0,0 +1,134 @@
+import contextlib
+import csv
+import logging
+import threading
+import time
+from functools import wraps
+
+# Stage timers and counters for the hot path. Off by default: a disabled timer is one check of a
+# module global, so the decorated functions cost next to nothing extra. Turn it on at runtime with
+#   stats = instrumentation.enable()                      in-process statistics
+#   instrumentation.enable(CsvSink("timings.csv"))       or any number of sinks
+# and off again with instrumentation.disable().
+
+_enabled = False
+_sinks = []
+_no_stage = contextlib.nullcontext()
+
+class StatsSink:
+    """Keeps count, total, minimum and maximum per stage and the totals of the counters, in memory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+    def record_time(self, name, seconds):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = {"count": 1, "total": seconds, "min": seconds, "max": seconds}
+            else:
+                stage["count"] += 1
+                stage["total"] += seconds
+                stage["min"] = min(stage["min"], seconds)
+                stage["max"] = max(stage["max"], seconds)
+
+    def record_count(self, name, amount):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        with self.lock:
+            for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]["total"]):
+                print(f"{name}: {stage['count']} calls, {1000 * stage['total'] / stage['count']:.2f} ms average, "
+                      f"{1000 * stage['max']:.2f} ms max, {stage['total']:.2f} s total")
+            for name, total in sorted(self.counters.items()):
+                print(f"{name}: {total}")
+
+class LogSink:
+    """Every measurement as a debug line of the 'instrumentation' logger."""
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("instrumentation")
+
+    def record_time(self, name, seconds):
+        self.logger.debug("%s %.3f ms", name, 1000 * seconds)
+
+    def record_count(self, name, amount):
+        self.logger.debug("%s +%s", name, amount)
+
+class CsvSink:
+    """Every measurement as a row (time, kind, name, value) of a CSV file, call close() when done."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["time", "kind", "name", "value"])
+
+    def record_time(self, name, seconds):
+        with self.lock:
+            self.writer.writerow([time.time(), "stage", name, seconds])
+
+    def record_count(self, name, amount):
+        with self.lock:
+            self.writer.writerow([time.time(), "counter", name, amount])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def enable(*sinks):
+    """Start measuring, into the given sinks or a new StatsSink. Returns the first sink."""
+    global _enabled
+    _sinks[:] = sinks or [StatsSink()]
+    _enabled = True
+    return _sinks[0]
+
+def disable():
+    global _enabled
+    _enabled = False
+    _sinks.clear()
+
+def is_enabled():
+    return _enabled
+
+def record_time(name, seconds):
+    for sink in _sinks:
+        sink.record_time(name, seconds)
+
+def count(name, amount=1):
+    if not _enabled:
+        return
+    for sink in _sinks:
+        sink.record_count(name, amount)
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(name, time.perf_counter() - start)
+
+def stage(name):
+    """with stage("cornerSubPix"): ... times the block when instrumentation is enabled."""
+    if not _enabled:
+        return _no_stage
+    return _timed_stage(name)
+
+def timed(name):
+    """Decorator that times every call of the function as stage name."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
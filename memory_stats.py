@@ -0,0 +1,65 @@
+import tracemalloc
+import cv2
+import numpy as np
+
+from corner_detection import find_corners_in_photo
+from recognizer import Recognizer
+
+# Measures how much memory every frame allocates. numpy (and so every image OpenCV returns)
+# reports its allocations to tracemalloc, so the peak per frame shows the temporary images.
+
+def measure_frames(process_frame, frames):
+    """
+    Runs process_frame on every frame. Per frame the peak of newly allocated memory (peak_bytes)
+    and the memory that was still in use afterwards (kept_bytes) are returned.
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+
+    results = []
+    for frame in frames:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        process_frame(frame)
+        current, peak = tracemalloc.get_traced_memory()
+        results.append({"peak_bytes": peak - before, "kept_bytes": current - before})
+
+    if not was_tracing:
+        tracemalloc.stop()
+    return results
+
+def main(path_board='./test_images/images_with_pieces/13.jpg', number_of_frames=20):
+    img = cv2.imread(path_board)
+    recognizer = Recognizer(verbose=False)
+
+    gray = recognizer.prepare_gray(img)
+    corners = find_corners_in_photo(gray, (recognizer.board_size - 1, recognizer.board_size - 1))
+    if corners is None:
+        print("No chessboard detected", path_board)
+        return
+    recognizer.set_corners(corners)
+
+    def pooled(frame):
+        recognizer.prepare_gray(frame)
+        recognizer.recognize(frame)
+
+    def unpooled(frame):
+        # what every frame used to cost: new gray, blurred, HSV and mask images
+        gray = cv2.medianBlur(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 13)
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        masks = {color: np.bitwise_or.reduce([cv2.inRange(hsv, lower, upper) for lower, upper in bounds])
+                 for color, bounds in recognizer.color_bounds.items()}
+        return gray, masks
+
+    frames = [img] * number_of_frames
+    for name, process_frame in [("pooled buffers", pooled), ("new images every frame", unpooled)]:
+        results = measure_frames(process_frame, frames)
+        steady = results[1:]
+        print(f"{name}: {np.mean([result['peak_bytes'] for result in steady]) / 1e6:.1f} MB peak allocation per frame "
+              f"(first frame {results[0]['peak_bytes'] / 1e6:.1f} MB)")
+    print(f"{recognizer.buffers.allocations} buffers allocated for {number_of_frames} frames, "
+          f"{recognizer.buffers.nbytes() / 1e6:.1f} MB in the pool")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+
+from cell_classifier import COLOR_BOUNDS
+from instrumentation import timed
+from recognizer import FrameBuffers
+
+# During a game at most one cell changes per move, so instead of searching the whole frame
+# for pieces again, only the cells that look different from the last accepted frame are classified.
+
+MoveEvent = namedtuple("MoveEvent", ["cell", "color", "timestamp"])
+
+def cell_boxes(grid, image_shape, scale=1.0, fill=0.6):
+    """
+    Square box (x0, y0, x1, y1) around the center of every cell, fill times the size of that cell,
+    at the given scale of the image. Cells close to the camera get a bigger box than cells far away.
+    """
+    size = grid.board_size
+    corners = grid.corners()
+    centers = grid.cell_centers().reshape(size, size, 2)
+
+    horizontal = np.linalg.norm(np.diff(corners, axis=1), axis=2)
+    vertical = np.linalg.norm(np.diff(corners, axis=0), axis=2)
+    widths = (horizontal[:-1] + horizontal[1:]) / 2
+    heights = (vertical[:, :-1] + vertical[:, 1:]) / 2
+    half_sizes = fill * np.minimum(widths, heights) / 2
+
+    height, width = image_shape[:2]
+    x0 = np.clip(np.floor((centers[..., 0] - half_sizes) * scale), 0, int(width * scale) - 1)
+    y0 = np.clip(np.floor((centers[..., 1] - half_sizes) * scale), 0, int(height * scale) - 1)
+    x1 = np.clip(np.ceil((centers[..., 0] + half_sizes) * scale), x0 + 1, int(width * scale))
+    y1 = np.clip(np.ceil((centers[..., 1] + half_sizes) * scale), y0 + 1, int(height * scale))
+    return np.stack([x0, y0, x1, y1], axis=-1).reshape(-1, 4).astype(int)
+
+def cell_means(image, boxes):
+    """Mean pixel value inside every box, all cells at once with an integral image."""
+    integral = cv2.integral(image)
+    x0, y0, x1, y1 = boxes.T
+    sums = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return sums / ((x1 - x0) * (y1 - y0))
+
+def classify_patch(patch, color_bounds=COLOR_BOUNDS, min_fraction=0.1):
+    """Returns the piece color in a cell patch (None for an empty cell) and the mean BGR color of the patch."""
+    hsv = cv2.cvtColor(patch, cv2.COLOR_BGR2HSV)
+    best_color = None
+    best_fraction = min_fraction
+    for color, bounds in color_bounds.items():
+        mask = None
+        for lower, upper in bounds:
+            color_mask = cv2.inRange(hsv, np.array(lower), np.array(upper))
+            mask = color_mask if mask is None else cv2.bitwise_or(mask, color_mask)
+        fraction = cv2.countNonZero(mask) / mask.size
+        if fraction >= best_fraction:
+            best_color = color
+            best_fraction = fraction
+    return best_color, cv2.mean(patch)[:3]
+
+class MoveDetector:
+    def __init__(self, grid, frame_shape, scale=0.25, change_threshold=15, settle_threshold=4,
+                 color_bounds=COLOR_BOUNDS, min_fraction=0.1):
+        self.grid = grid
+        self.scale = scale
+        self.change_threshold = change_threshold
+        self.settle_threshold = settle_threshold
+        self.color_bounds = color_bounds
+        self.min_fraction = min_fraction
+
+        height, width = frame_shape[:2]
+        self.small_size = (int(round(width * scale)), int(round(height * scale)))
+        self.buffers = FrameBuffers()
+
+        self.boxes = cell_boxes(grid, frame_shape)
+        self.small_boxes = cell_boxes(grid, frame_shape, scale=scale)
+
+        number_of_cells = grid.board_size * grid.board_size
+        self.state = [None] * number_of_cells
+        self.cell_colors = np.zeros((number_of_cells, 3))
+        self.reference = None
+        self.previous = None
+
+        self.frames_processed = 0
+        self.cells_classified = 0
+
+    def get_coordinates(self, index):
+        return (index // self.grid.board_size, index % self.grid.board_size)
+
+    def pieces(self):
+        """The current board state in the format of Recognizer.recognize: a list of (color, (row, column))."""
+        return [(color, self.get_coordinates(index)) for index, color in enumerate(self.state) if color is not None]
+
+    def classify_cell(self, frame, index):
+        x0, y0, x1, y1 = self.boxes[index]
+        color, mean_color = classify_patch(frame[y0:y1, x0:x1], self.color_bounds, self.min_fraction)
+        self.cell_colors[index] = mean_color
+        self.cells_classified += 1
+        return color
+
+    @timed("MoveDetector.update")
+    def update(self, frame, timestamp=None):
+        """
+        Feed the next frame, returns the list of MoveEvents it caused.
+        The first frame is scanned completely and reports every piece that is already on the board.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.frames_processed += 1
+
+        width, height = self.small_size
+        small = cv2.resize(frame, self.small_size, dst=self.buffers.get("small", (height, width, 3)),
+                           interpolation=cv2.INTER_AREA)
+        # two gray buffers take turns, the other one still holds the previous frame
+        small_gray = self.buffers.get(f"gray {self.frames_processed % 2}", (height, width))
+        cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=small_gray)
+
+        if self.reference is None:
+            candidates = range(len(self.state))
+            self.reference = small_gray.copy()
+        else:
+            # changed compared to the last accepted frame, but no longer moving (no hand in the way)
+            difference = self.buffers.get("difference", (height, width))
+            changed = cell_means(cv2.absdiff(small_gray, self.reference, dst=difference), self.small_boxes) > self.change_threshold
+            settled = cell_means(cv2.absdiff(small_gray, self.previous, dst=difference), self.small_boxes) < self.settle_threshold
+            candidates = np.flatnonzero(changed & settled)
+        self.previous = small_gray
+
+        events = []
+        for index in candidates:
+            color = self.classify_cell(frame, index)
+
+            x0, y0, x1, y1 = self.small_boxes[index]
+            self.reference[y0:y1, x0:x1] = small_gray[y0:y1, x0:x1]
+
+            if color != self.state[index]:
+                self.state[index] = color
+                events.append(MoveEvent(self.get_coordinates(int(index)), color, timestamp))
+        return events
@@ -0,0 +1,120 @@
+import cv2
+import numpy as np
+
+from instrumentation import count, timed
+from recognizer import FrameBuffers
+
+# While a player reaches over the board every frame shows a hand instead of pieces: the chessboard
+# check thinks the board moved and the masks are full of garbage. A downscaled gray copy of the frame
+# is compared with the previous one; when too many pixels changed the frame is occluded and the heavy
+# stages are skipped, until the scene has been calm for settle_frames frames in a row.
+# Optionally skin colored pixels (YCrCb) count as occlusion as well: the wooden table and the light
+# squares are close to skin tones, so it is the increase of the skin share over the calm frames that counts.
+
+SMALL_WIDTH = 160
+MOTION_THRESHOLD = 25 # gray levels
+MAX_MOTION_RATIO = 0.02
+SETTLE_FRAMES = 3
+SKIN_BOUNDS = ((0, 133, 77), (255, 173, 127)) # YCrCb
+
+class OcclusionFilter:
+    def __init__(self, small_width=SMALL_WIDTH, motion_threshold=MOTION_THRESHOLD, max_motion_ratio=MAX_MOTION_RATIO,
+                 settle_frames=SETTLE_FRAMES, max_skin_ratio=None, skin_bounds=SKIN_BOUNDS):
+        self.small_width = small_width
+        self.motion_threshold = motion_threshold
+        self.max_motion_ratio = max_motion_ratio
+        self.settle_frames = settle_frames
+        self.max_skin_ratio = max_skin_ratio
+        self.skin_bounds = tuple(np.array(bound, dtype=np.uint8) for bound in skin_bounds)
+
+        self.buffers = FrameBuffers()
+        self.previous = None
+        self.region = None
+        self.calm_frames = settle_frames
+        self.motion_ratio = 0.0
+        self.skin_ratio = 0.0
+        self.skin_baseline = None
+
+        self.frames_checked = 0
+        self.frames_skipped = 0
+        self.occlusions = 0
+
+    def small_shape(self, frame_shape):
+        height, width = frame_shape[:2]
+        return int(round(height * self.small_width / width)), self.small_width
+
+    def set_board(self, grid, frame_shape):
+        """Only look at the board (plus a small margin) instead of the whole frame, grid=None to undo."""
+        self.skin_baseline = None
+        if grid is None:
+            self.region = None
+            return
+        height, width = self.small_shape(frame_shape)
+        scale = width / frame_shape[1]
+        outline = grid.board_to_image(np.array([[-0.5, -0.5], [grid.board_size + 0.5, -0.5],
+                                                [grid.board_size + 0.5, grid.board_size + 0.5],
+                                                [-0.5, grid.board_size + 0.5]])) * scale
+        self.region = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillConvexPoly(self.region, np.round(outline).astype(np.int32), 255)
+
+    def share(self, mask):
+        if self.region is None:
+            return cv2.countNonZero(mask) / mask.size
+        cv2.bitwise_and(mask, self.region, dst=mask)
+        return cv2.countNonZero(mask) / max(1, cv2.countNonZero(self.region))
+
+    @timed("OcclusionFilter.check")
+    def check(self, frame):
+        """True when the frame can be processed, False while the board is occluded or not calm yet."""
+        self.frames_checked += 1
+        height, width = self.small_shape(frame.shape)
+        # INTER_AREA over every pixel of a full HD frame costs more than the rest together,
+        # on every n-th pixel (still about 2 per small pixel) it is almost free
+        step = max(1, frame.shape[1] // (2 * width))
+        small = cv2.resize(frame[::step, ::step], (width, height), dst=self.buffers.get("small", (height, width, 3)),
+                           interpolation=cv2.INTER_AREA)
+        # two gray buffers take turns, the other one still holds the previous frame
+        gray = self.buffers.get(f"gray {self.frames_checked % 2}", (height, width))
+        cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=gray)
+
+        occluded = False
+        if self.previous is not None:
+            difference = self.buffers.get("difference", (height, width))
+            cv2.absdiff(gray, self.previous, dst=difference)
+            cv2.threshold(difference, self.motion_threshold, 255, cv2.THRESH_BINARY, dst=difference)
+            self.motion_ratio = self.share(difference)
+            occluded = self.motion_ratio > self.max_motion_ratio
+        self.previous = gray
+
+        if self.max_skin_ratio is not None:
+            ycrcb = self.buffers.get("ycrcb", (height, width, 3))
+            cv2.cvtColor(small, cv2.COLOR_BGR2YCrCb, dst=ycrcb)
+            skin = self.buffers.get("skin", (height, width))
+            cv2.inRange(ycrcb, self.skin_bounds[0], self.skin_bounds[1], dst=skin)
+            self.skin_ratio = self.share(skin)
+            if self.skin_baseline is None:
+                self.skin_baseline = self.skin_ratio
+            occluded = occluded or self.skin_ratio - self.skin_baseline > self.max_skin_ratio
+            if not occluded:
+                self.skin_baseline = 0.9 * self.skin_baseline + 0.1 * self.skin_ratio
+
+        if occluded:
+            if self.calm_frames >= self.settle_frames:
+                self.occlusions += 1
+                count("occlusions")
+            self.calm_frames = 0
+        else:
+            self.calm_frames += 1
+
+        if self.calm_frames < self.settle_frames:
+            self.frames_skipped += 1
+            count("frames skipped (occluded)")
+            return False
+        return True
+
+    def occluded(self):
+        return self.calm_frames < self.settle_frames
+
+    def report(self):
+        print(f"{self.frames_skipped} of {self.frames_checked} frames skipped because the board was occluded "
+              f"({self.occlusions} occlusions)")
@@ -0,0 +1,249 @@
+import datetime
+import glob
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+
+from board_state import BoardState
+from cell_classifier import COLOR_BOUNDS
+from corner_detection import DetectionCascade
+from recognizer import BOARD_SIZE, FrameBuffers, Recognizer, get_ellipse_centers
+
+# Frame by frame, the recognition runs one stage after the other: while the chessboard detection of a
+# frame runs, nothing else happens. OpenCV releases the GIL in its heavy calls (findChessboardCornersSB,
+# cornerSubPix, cvtColor, inRange, findContours), so threads can overlap them: every stage gets its own
+# worker thread(s) and a small bounded queue in front of it, and different frames are in different
+# stages at the same time. On a machine with enough cores the throughput approaches that of the
+# slowest stage instead of the sum of all stages; the queues keep the number of frames in flight
+# (and with it the latency and the memory) small.
+#   capture -> grid -> color masks + matching -> publish
+# The masks and the matching of a frame run in the same worker, so the masks can stay in the pooled
+# buffers of that worker instead of being allocated (or copied) per frame for the next stage.
+
+QUEUE_SIZE = 2
+STOP = object()
+
+class Stage:
+    """
+    function(item) returns the item for the next stage, or None to drop the frame (no board found).
+    Stages with more workers handle several frames at once and can finish them out of order;
+    an ordered stage (always one worker) gets them in capture order again.
+    """
+
+    def __init__(self, name, function, workers=1, ordered=False):
+        if ordered and workers != 1:
+            raise ValueError("An ordered stage has exactly one worker.")
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.ordered = ordered
+        self.items = 0
+        self.dropped = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+class Pipeline:
+    def __init__(self, stages, queue_size=QUEUE_SIZE, collect=False):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.collect = collect
+        self.results = []
+        self.frames = 0
+        self.seconds = 0.0
+        self._running = [stage.workers for stage in stages]
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Stop taking new frames, the frames in flight still go through all stages."""
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self, frames):
+        """Push every frame of the iterable frames through the stages, returns when the last one is done."""
+        threads = [threading.Thread(target=self.work, args=(index,), daemon=True)
+                   for index, stage in enumerate(self.stages) for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        start = time.perf_counter()
+        try:
+            for number, frame in enumerate(frames):
+                if self.stopped():
+                    break
+                # blocks while the first stage is busy: a live source keeps only its newest frame meanwhile
+                self.queues[0].put((number, frame))
+                self.frames += 1
+        finally:
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(STOP)
+            for thread in threads:
+                thread.join()
+        self.seconds = time.perf_counter() - start
+        return self.results
+
+    def work(self, index):
+        stage = self.stages[index]
+        pending = {}
+        next_number = 0
+        while True:
+            item = self.queues[index].get()
+            if item is STOP:
+                break
+            if not stage.ordered:
+                self.process(index, item)
+                continue
+            pending[item[0]] = item
+            while next_number in pending:
+                self.process(index, pending.pop(next_number))
+                next_number += 1
+
+        with self._lock:
+            self._running[index] -= 1
+            last_worker = self._running[index] == 0
+        if last_worker and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self.queues[index + 1].put(STOP)
+
+    def process(self, index, item):
+        stage = self.stages[index]
+        number, data = item
+        # a dropped frame still goes through as (number, None), so the ordered stages don't wait for it
+        if data is not None:
+            start = time.perf_counter()
+            try:
+                data = stage.function(data)
+            except Exception as error:
+                print(f"{stage.name} failed on frame {number}: {error!r}")
+                data = None
+                stage.errors += 1
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage.items += 1
+                stage.seconds += elapsed
+                if data is None:
+                    stage.dropped += 1
+
+        if index + 1 < len(self.stages):
+            self.queues[index + 1].put((number, data))
+        elif self.collect:
+            with self._lock:
+                self.results.append((number, data))
+
+    def report(self):
+        for stage in self.stages:
+            per_item = 1000 * stage.seconds / stage.items if stage.items else 0.0
+            print(f"{stage.name}: {stage.items} frames, {per_item:.1f} ms per frame on {stage.workers} worker(s), "
+                  f"{stage.dropped} dropped")
+        if self.seconds > 0:
+            busiest = max(self.stages, key=lambda stage: stage.seconds / stage.workers)
+            print(f"{self.frames} frames in {self.seconds:.1f} s: {self.frames / self.seconds:.1f} fps "
+                  f"(slowest stage: {busiest.name})")
+
+def recognition_stages(locate, publish, color_bounds=COLOR_BOUNDS, board_size=BOARD_SIZE, workers=2):
+    """
+    The stages after capture. locate(frame) returns (grid, avg_distances) or None and runs in one ordered
+    worker (it may keep state, like the cached geometry or the seed of the cascade); publish(item) gets
+    {"frame", "recognizer", "pieces", "state", "timestamp"} in capture order.
+    The masks and the matching run in workers threads, every thread with its own buffers.
+    """
+    board = {"grid": None, "recognizer": None}
+    local = threading.local()
+
+    def grid_stage(frame):
+        located = locate(frame)
+        if located is None:
+            return None
+        grid, avg_distances = located
+        if grid is not board["grid"]:
+            # a recognizer per grid: the frames that are still in the later stages keep the one they started with
+            recognizer = Recognizer(board_size, color_bounds, verbose=False)
+            recognizer.set_grid(grid, avg_distances)
+            board["grid"], board["recognizer"] = grid, recognizer
+        return {"frame": frame, "recognizer": board["recognizer"], "timestamp": datetime.datetime.now().isoformat()}
+
+    def recognition_stage(item):
+        frame = item["frame"]
+        recognizer = item["recognizer"]
+        height, width = frame.shape[:2]
+        # the workers share the recognizer, its pooled buffers would be overwritten by the frame of the
+        # other worker: every worker keeps buffers of its own, reused for all of its frames
+        buffers = getattr(local, "buffers", None)
+        if buffers is None:
+            buffers = local.buffers = FrameBuffers()
+        masks = recognizer.color_masks(frame, hsv=buffers.get("hsv", (height, width, 3)),
+                                       masks={color: buffers.get("mask " + color, (height, width)) for color in color_bounds},
+                                       range_mask=buffers.get("range mask", (height, width)))
+        found_shapes = []
+        for color, mask in masks.items():
+            ellipses = recognizer.detect_ellipses(mask, shape=f"{color} ellipses")
+            found_shapes += recognizer.match_shapes_to_centers(get_ellipse_centers(ellipses), color)
+        item["pieces"] = list(set(found_shapes))
+        item["state"] = BoardState.from_pieces(item["pieces"], board_size)
+        return item
+
+    def publish_stage(item):
+        publish(item)
+        return item
+
+    return [
+        Stage("grid", grid_stage, ordered=True),
+        Stage("color masks + matching", recognition_stage, workers=workers),
+        Stage("publish", publish_stage, ordered=True),
+    ]
+
+def main(pattern='./test_images/images_with_pieces/*.jpg', repeat=5, workers=2):
+    """
+    Every test image repeat times (like a camera that looks at the same board), once one stage after
+    the other and once pipelined. The boards that are found have to be the same.
+    """
+    frames = []
+    for path_board in sorted(glob.glob(pattern)):
+        if "_processed" not in path_board:
+            frames += [cv2.imread(path_board)] * repeat
+    number_of_corners = (BOARD_SIZE - 1, BOARD_SIZE - 1)
+
+    def make_locate():
+        # with the seed tier: the repeated frames are found again by refining the corners of the previous one
+        cascade = DetectionCascade(number_of_corners)
+        state = {"grid": None, "corners": None}
+
+        def locate(frame):
+            gray = cv2.medianBlur(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 13)
+            corners = cascade.detect(gray)
+            if corners is None:
+                return None
+            if state["corners"] is None or not np.array_equal(corners, state["corners"]):
+                recognizer = Recognizer(BOARD_SIZE, verbose=False)
+                recognizer.set_corners(corners)
+                state["grid"], state["corners"] = recognizer.grid, corners
+                state["avg_distances"] = (recognizer.avg_horizontal, recognizer.avg_vertical)
+            return state["grid"], state["avg_distances"]
+        return locate
+
+    sequential = []
+    stages = recognition_stages(make_locate(), lambda item: sequential.append(item["state"]), workers=1)
+    start = time.perf_counter()
+    for frame in frames:
+        item = frame
+        for stage in stages:
+            item = stage.function(item)
+            if item is None:
+                break
+    sequential_time = time.perf_counter() - start
+    print(f"one stage after the other: {len(frames)} frames in {sequential_time:.1f} s, "
+          f"{len(frames) / sequential_time:.1f} fps")
+
+    pipelined = []
+    pipeline = Pipeline(recognition_stages(make_locate(), lambda item: pipelined.append(item["state"]), workers=workers))
+    pipeline.run(frames)
+    pipeline.report()
+    print(f"pipelined on {workers} workers per parallel stage: {len(frames) / pipeline.seconds:.1f} fps, "
+          f"{sequential_time / pipeline.seconds:.2f}x, same boards: {sequential == pipelined}")
+
+if __name__ == "__main__":
+    main()
@@ -1,233 +1,325 @@
 
 import datetime
-import glob
-import json
-from time import sleep
+import threading
 import cv2
 import numpy as np
 
+from board_cache import board_has_moved, forget_board_geometry, load_board_geometry, save_board_geometry
+from board_server import HOST, PORT, BoardServer
+from board_state import BoardState
+from board_grid import BoardGrid
+from camera_calibration import BoardRectifier, load_calibration
+from color_profiles import load_color_bounds
+from corner_detection import DetectionCascade
+from frame_stream import FrameGrabber, run_stream
+import instrumentation
+from instrumentation import count, timed
+from move_detection import MoveDetector
+from occlusion_filter import OcclusionFilter
+from pipeline import Pipeline, recognition_stages
+from recognizer import Recognizer, draw_overlay
+from result_publisher import ResultPublisher
+from temporal_filter import TemporalFilter
+
 BOARD_SIZE = 15
 corners_to_be_found = BOARD_SIZE - 1 
-
-def calculate_euclidean_distance(p1, p2):
-    return np.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
-
-def determine_average_distances(corners):
-    corners = corners.reshape((corners_to_be_found, corners_to_be_found, 2))
-    
-    horizontal_distances = []
-    vertical_distances = []
-
-    for i in range(corners_to_be_found):
-        for j in range(corners_to_be_found):
-            p1 = corners[i, j]
-
-            # add horizontal distances
-            if j + 1 < corners_to_be_found:
-                p2 = corners[i, j + 1]
-                horizontal_distances.append(calculate_euclidean_distance(p1, p2))
-
-            # add vertical distances
-            if i + 1 < corners_to_be_found:
-                p3 = corners[i + 1, j]
-                vertical_distances.append(calculate_euclidean_distance(p1, p3))
-
-    # calculate average distances
-    avg_horizontal_distance = np.mean(horizontal_distances)
-    avg_vertical_distance = np.mean(vertical_distances)
-
-    return avg_horizontal_distance, avg_vertical_distance
-
-def extrapolate_other_corners(corners, avg_distances):
-    global avg_horizontal, avg_vertical
-    avg_horizontal, avg_vertical = avg_distances
-
-    complete_corners = np.zeros((BOARD_SIZE + 1, BOARD_SIZE + 1, 2), dtype=np.float32)
-    complete_corners[1:-1, 1:-1] = corners.reshape((corners_to_be_found, corners_to_be_found, 2))
-
-    for i in range(1, BOARD_SIZE):
-        complete_corners[i, -1] = [complete_corners[i, -2, 0] + avg_horizontal, complete_corners[i, -2, 1]]
-
-    for j in range(1, BOARD_SIZE):
-        complete_corners[-1, j] = [complete_corners[-2, j, 0], complete_corners[-2, j, 1] + avg_vertical]
-
-    for i in range(1, BOARD_SIZE):
-        complete_corners[i, 0] = [complete_corners[i, 1, 0] - avg_horizontal, complete_corners[i, 1, 1]]
-
-    for j in range(1, BOARD_SIZE):
-        complete_corners[0, j] = [complete_corners[1, j, 0], complete_corners[1, j, 1] - avg_vertical]
-
-    complete_corners[0, 0] = [complete_corners[1, 1, 0] - avg_horizontal, complete_corners[1, 1, 1] - avg_vertical]
-    complete_corners[0, -1] = [complete_corners[1, -2, 0] + avg_horizontal, complete_corners[1, -2, 1] - avg_vertical]
-    complete_corners[-1, 0] = [complete_corners[-2, 1, 0] - avg_horizontal, complete_corners[-2, 1, 1] + avg_vertical]
-    complete_corners[-1, -1] = [complete_corners[-2, -2, 0] + avg_horizontal, complete_corners[-2, -2, 1] + avg_vertical]
-
-    return complete_corners
-
-def calculate_cell_centers(corners):
-    centers = []
-    for i in range(BOARD_SIZE):
-        for j in range(BOARD_SIZE):
-            p1 = corners[i, j]
-            p2 = corners[i, j + 1]
-            p3 = corners[i + 1, j]
-            p4 = corners[i + 1, j + 1]
-            center_x = (p1[0] + p2[0] + p3[0] + p4[0]) / 4
-            center_y = (p1[1] + p2[1] + p3[1] + p4[1]) / 4
-            centers.append((center_x, center_y))
-    return np.array(centers)
-
-
-def detect_pieces(cell_centers, img):    
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-
-    lower_blue = np.array([100, 150, 50])
-    upper_blue = np.array([140, 255, 255])
-    
-    lower_red1 = np.array([0, 120, 70])
-    upper_red1 = np.array([10, 255, 255])
-    lower_red2 = np.array([170, 120, 70])
-    upper_red2 = np.array([180, 255, 255])
-
-    mask_blue = cv2.inRange(hsv, lower_blue, upper_blue)
-    mask_red1 = cv2.inRange(hsv, lower_red1, upper_red1)
-    mask_red2 = cv2.inRange(hsv, lower_red2, upper_red2)
-    mask_red = mask_red1 + mask_red2
-    
-    blue_ellipses = detect_and_draw_ellipses(img, mask_blue, color=(255, 0, 0), shape="blue ellipses")
-    red_ellipses = detect_and_draw_ellipses(img, mask_red, color=(0, 0, 255), shape="red ellipses")
-
-    list_blue_shapes=match_shapes_to_centers(blue_ellipses, cell_centers, img,"blue")
-    list_red_shapes=match_shapes_to_centers(red_ellipses, cell_centers, img,"red")
-
-    print("detected",len(list_blue_shapes),"blue pieces")
-    print("detected",len(list_red_shapes),"red pieces")
-
-    all_shapes = blue_ellipses + red_ellipses
-
-    list_shapes = list(set(list_blue_shapes + list_red_shapes))
-
-    data = {
-            "timestamp": datetime.datetime.now().isoformat(),
-            "pieces": list_shapes
-        }
-        
-    with open('detected_pieces.json', 'w') as json_file:
-        json.dump(data, json_file, indent=4, default=int) # convert numpy array to int
-
-    cv2.namedWindow("Detected Pieces", cv2.WINDOW_NORMAL)
-    cv2.imshow("Detected Pieces", img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-
-def detect_and_draw_ellipses(img, mask, color, shape="ellipses", min_area=50):
-    global avg_horizontal, avg_vertical
-    # Zoek contouren in het masker
-    contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    min_area = (avg_horizontal * avg_vertical)/60
-    max_area = (avg_horizontal * avg_vertical)+10
-    detected_ellipses = []
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if max_area>=area >= min_area and len(cnt) >= 5:
-            ellipse = cv2.fitEllipse(cnt)
-            cv2.ellipse(img, ellipse, color, 2)
-            center = (int(ellipse[0][0]), int(ellipse[0][1]))  
-            detected_ellipses.append(center)  
-    print(f"Detected {len(detected_ellipses)} {shape}.")
-    
-    return detected_ellipses  
-
-def get_coordinates(index):
-    x = index[0]//BOARD_SIZE
-    y = index[0]%BOARD_SIZE
-    return (x,y)
-
-def match_shapes_to_centers(shapes, cell_centers, img,color):
+DETECTION_ENGINE = "ellipses" # "ellipses", "cells" or "reference" (stream() only: differences with the empty board), see Recognizer.recognize
+COLOR_PROFILE = None # name of a profile saved by calibrate_color, None: the default colors (see color_profiles.py)
+SHOW_WINDOWS = True # False: headless, no windows and no drawing
+SKIP_OCCLUDED = True # stream(): skip the frames in which a hand is over the board, see occlusion_filter.py
+SMOOTHING = True # stream(): a cell only changes after it was the same in most of the last frames, see temporal_filter.py
+COMPACT_JSON = False # True: detected_pieces.json without indentation
+INSTRUMENTATION = False # True: stream() times every stage and prints the statistics when it stops, see instrumentation.py
+RECTIFY = False # stream(): look for the pieces on a top-down image of the board, see camera_calibration.py
+
+publisher = None
+
+def get_publisher():
     """
-    Voor elk gedetecteerd object (cirkel of ellips), bepaal welk celcentrum het dichtstbijzijnde is
-    en teken de lijn tussen hen op de afbeelding.
+    The publisher that writes detected_pieces.json (in the background, only when the board changed).
+    A program that builds this in can follow the moves without reading the file:
+    get_publisher().subscribe(callback) or changes = get_publisher().subscribe(), see result_publisher.py
     """
-    list_shapes = []
-    for shape in shapes:
-        closest_center = None
-        min_distance = float("inf")
-        
-        for center in cell_centers:
-            distance = np.linalg.norm(np.array(shape) - np.array(center))
-            if distance < min_distance:
-                min_distance = distance
-                closest_center = center
-        
-        max_distance=(avg_horizontal+avg_vertical)/2
-
-        if min_distance>max_distance:
-            continue
-
-        if closest_center.any():
-            result=np.where(cell_centers == closest_center)
-            index = (result[0][0], result[1][0])
-            coordinates= get_coordinates(index)
-
-            list_shapes.append((color,coordinates))
-
-
-            shape_point = tuple(map(int, shape))  
-            closest_center_point = tuple(map(int, closest_center)) 
-            
-
-            cv2.line(img, shape_point, closest_center_point, (0, 255, 0), 2)
-            cv2.circle(img, shape_point, 5, (0, 255, 255), -1)  
-            cv2.circle(img, closest_center_point, 5, (255, 255, 0), -1)  
-
-    return list_shapes
-
-def main():
+    global publisher
+    if publisher is None:
+        publisher = ResultPublisher(compact=COMPACT_JSON)
+    return publisher
+
+def publish_state(state, temporal_filter=None, timestamp=None):
+    """Publish the state of one frame, or with a temporal_filter only what has been stable for a couple of frames."""
+    if temporal_filter is not None:
+        state, added, removed = temporal_filter.update(state)
+        for color, cell in added:
+            print("move:", color, "on", cell)
+        for color, cell in removed:
+            print("removed:", color, "from", cell)
+        if not temporal_filter.ready():
+            return state
+    get_publisher().publish(state, timestamp)
+    return state
+
+@timed("detect_pieces")
+def detect_pieces(recognizer, img, engine=DETECTION_ENGINE, wait_key=0, show=SHOW_WINDOWS, temporal_filter=None):
+    result = recognizer.recognize(img, engine)
+
+    print("detected",sum(color == "blue" for color, _ in result["pieces"]),"blue pieces")
+    print("detected",sum(color == "red" for color, _ in result["pieces"]),"red pieces")
+
+    publish_state(result["state"], temporal_filter, result["timestamp"])
+
+    if show:
+        cv2.namedWindow("Detected Pieces", cv2.WINDOW_NORMAL)
+        cv2.imshow("Detected Pieces", draw_overlay(img, result))
+        if wait_key is not None:
+            cv2.waitKey(wait_key)
+            cv2.destroyAllWindows()
+
+    return result
+
+@timed("get_board_geometry")
+def get_board_geometry(recognizer, gray, camera_id, cascade):
+    """
+    Reuse the cached board geometry for this camera and resolution as long as the board did not move,
+    only run the chessboard detection (cascade, see corner_detection.py) when there is no usable cache.
+    The grid of the geometry is loaded into the recognizer.
+    """
+    resolution = (gray.shape[1], gray.shape[0])
+
+    geometry = load_board_geometry(camera_id, resolution)
+    if geometry is not None and not board_has_moved(gray, geometry):
+        print("Chessboard geometry reused from cache")
+        count("geometry cache hits")
+        if recognizer.grid is None or not np.array_equal(recognizer.grid.homography, geometry["homography"]):
+            recognizer.set_grid(BoardGrid(geometry["homography"], BOARD_SIZE), geometry["avg_distances"])
+        return geometry
+
+    if geometry is not None:
+        print("Chessboard has moved, detecting it again")
+        forget_board_geometry(camera_id, resolution)
+        if cascade.last_corners is None:
+            # a board that only slid a little is found again by refining the old corners
+            cascade.last_corners = geometry["corners"]
+
+    count("geometry detections")
+    corners = cascade.detect(gray)
+    if corners is None:
+        return None
+
+    recognizer.set_corners(corners)
+
+    return save_board_geometry(camera_id, resolution, gray, corners, recognizer.grid,
+                               (recognizer.avg_horizontal, recognizer.avg_vertical))
+
+def main(camera_id=1, show=SHOW_WINDOWS):
     number_of_corners = (corners_to_be_found, corners_to_be_found)
-    cap=cv2.VideoCapture(1)
+    recognizer = Recognizer(BOARD_SIZE, load_color_bounds(COLOR_PROFILE))
+    cascade = DetectionCascade(number_of_corners)
+    cap=cv2.VideoCapture(camera_id)
 
     ret_img,img=cap.read()
+    cap.release()
 
     if not ret_img:
         print("Error: Could not read frame.")
         return
 
-    cv2.imshow("img",img)
-    cv2.waitKey(0)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if show:
+        cv2.imshow("img",img)
+        cv2.waitKey(0)
+    gray = recognizer.prepare_gray(img)
 
-    gray = cv2.medianBlur(gray, 13)
-       
-    ret, corners = cv2.findChessboardCornersSB(gray, number_of_corners,
-                                            flags= cv2.CALIB_CB_EXHAUSTIVE +cv2.CALIB_CB_ACCURACY )
-    
-    if not ret:
-        print("no chessboard detected at first")
-        ret, corners= cv2.findChessboardCorners(gray, number_of_corners, flags= cv2.CALIB_CB_PLAIN +cv2.CALIB_CB_FAST_CHECK )
+    geometry = get_board_geometry(recognizer, gray, camera_id, cascade)
 
-    if ret:
+    result = None
+    if geometry is not None:
         print("Chessboard detected")
-        img=corners = corners.squeeze()
-
-        corners = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), 
-                                    criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001))
-        
-        avg_distances = determine_average_distances(corners)
-        
-        all_corners = extrapolate_other_corners(corners, avg_distances)
-        
-        img_with_corners = img.copy()
-        img_with_corners = cv2.drawChessboardCorners(img_with_corners, (BOARD_SIZE + 1, BOARD_SIZE + 1), all_corners.reshape(-1, 1, 2), ret)
-
-        cell_centers = calculate_cell_centers(all_corners)
-
-        detect_pieces(cell_centers,img)
 
+        result = detect_pieces(recognizer,img,show=show)
 
     else:
         print("No chessboard detected")
 
-    cv2.destroyAllWindows()
+    if show:
+        cv2.destroyAllWindows()
+    return result
+
+def stream(camera_id=1, incremental=False, show=SHOW_WINDOWS, instrumented=INSTRUMENTATION, smoothing=SMOOTHING,
+           skip_occluded=SKIP_OCCLUDED, rectify=RECTIFY):
+    """
+    Follow the board live: a separate thread reads the camera and every iteration
+    handles the newest frame. Press q to stop (or stop the process when show is False).
+    With incremental=True only the cells that changed are classified and the moves are printed
+    instead of searching the whole frame for pieces every time.
+    With smoothing=True a move is only published once it was seen in most of the last frames.
+    With skip_occluded=True frames with a lot of motion (a hand over the board) are not processed at all,
+    until the scene is calm again.
+    With rectify=True the board is warped into a small top-down image (without lens distortion when the
+    camera has been calibrated with camera_calibration.py) and the pieces are searched on that image.
+    With DETECTION_ENGINE "reference" the first frame in which the board is found is stored as the empty board
+    (press e to capture it again), a cell is occupied when it differs from it (see empty_board.py).
+    """
+    stats = instrumentation.enable() if instrumented else None
+    number_of_corners = (corners_to_be_found, corners_to_be_found)
+    recognizer = Recognizer(BOARD_SIZE, load_color_bounds(COLOR_PROFILE))
+    cascade = DetectionCascade(number_of_corners)
+    detector = None
+    temporal_filter = TemporalFilter(BOARD_SIZE) if smoothing else None
+    occlusion_filter = OcclusionFilter() if skip_occluded else None
+    current_grid = None
+    detector_grid = None
+    rectifier = None
+    # the recognizer of the rectified image: always the same size and a regular grid
+    board_recognizer = Recognizer(BOARD_SIZE, recognizer.color_bounds) if rectify else None
+    empty_board_captured = False
+
+    def process_frame(img):
+        nonlocal detector, detector_grid, current_grid, rectifier, empty_board_captured
+        if occlusion_filter is not None and not occlusion_filter.check(img):
+            # a hand over the board: no chessboard detection, no masks, nothing published
+            if not show:
+                return True
+            cv2.namedWindow("Detected Pieces", cv2.WINDOW_NORMAL)
+            cv2.imshow("Detected Pieces", img)
+            return cv2.waitKey(1) & 0xFF != ord('q')
+
+        # gray and median blurred, written in the buffers of the recognizer: no new images per frame
+        gray = recognizer.prepare_gray(img)
+
+        overlay = img
+        geometry = get_board_geometry(recognizer, gray, camera_id, cascade)
+        if geometry is not None and current_grid is not recognizer.grid:
+            current_grid = recognizer.grid
+            if temporal_filter is not None:
+                # other grid, other cells: the history of the old one means nothing any more
+                temporal_filter.reset()
+            if occlusion_filter is not None:
+                occlusion_filter.set_board(current_grid, img.shape)
+            if rectify:
+                if rectifier is None:
+                    rectifier = BoardRectifier(load_calibration(camera_id, (img.shape[1], img.shape[0])), BOARD_SIZE)
+                # one remap table per board position, from then on a single remap per frame
+                rectifier.set_corners(geometry["corners"])
+                board_recognizer.set_grid(rectifier.rectified_grid, rectifier.avg_distances())
+
+        pieces_recognizer = recognizer
+        if geometry is not None and rectify:
+            pieces_recognizer = board_recognizer
+            img = rectifier.rectify(img)
+            overlay = img
+        if geometry is not None and incremental:
+            if detector is None or detector_grid is not current_grid:
+                # new or moved board: start over with a full scan (the rectified grid stays the same, the board behind it not)
+                detector = MoveDetector(pieces_recognizer.grid, img.shape, color_bounds=pieces_recognizer.color_bounds)
+                detector_grid = current_grid
+            events = detector.update(img)
+            if temporal_filter is not None:
+                publish_state(BoardState.from_pieces(detector.pieces(), BOARD_SIZE), temporal_filter)
+            else:
+                for event in events:
+                    print("move:", event.color, "on", event.cell, "at", datetime.datetime.fromtimestamp(event.timestamp).isoformat())
+                if events:
+                    get_publisher().publish(detector.pieces())
+        elif geometry is not None:
+            engine = DETECTION_ENGINE
+            if engine == "reference" and not empty_board_captured:
+                # the board is expected to be empty when the stream starts
+                pieces_recognizer.capture_empty_board(img)
+                empty_board_captured = True
+                print("Empty board captured, press e to capture it again")
+            if engine == "reference" and not pieces_recognizer.has_empty_board():
+                # the board moved after the capture (the rectified board does not lose it): the HSV bounds until e is pressed
+                engine = "cells"
+            result = detect_pieces(pieces_recognizer, img, engine=engine, show=False, temporal_filter=temporal_filter)
+            if show:
+                overlay = draw_overlay(img, result)
+
+        if not show:
+            return True
+        cv2.namedWindow("Detected Pieces", cv2.WINDOW_NORMAL)
+        cv2.imshow("Detected Pieces", overlay)
+        key = cv2.waitKey(1) & 0xFF
+        if key == ord('e') and geometry is not None:
+            pieces_recognizer.capture_empty_board(img, new=True)
+            print("Empty board captured")
+        return key != ord('q')
+
+    run_stream(process_frame, camera_id=camera_id)
+    cascade.report()
+    if occlusion_filter is not None:
+        occlusion_filter.report()
+    if stats is not None:
+        stats.report()
+        instrumentation.disable()
+    if show:
+        cv2.destroyAllWindows()
+
+def stream_pipelined(camera_id=1, workers=2, smoothing=SMOOTHING, instrumented=INSTRUMENTATION):
+    """
+    Headless stream() in which the stages overlap: while one frame is in the chessboard check the
+    previous ones are in the color masks and the matching (see pipeline.py). Only faster on a machine
+    with more than one core. The moves are published in the order of the frames. Stop it with Ctrl+C.
+    """
+    stats = instrumentation.enable() if instrumented else None
+    number_of_corners = (corners_to_be_found, corners_to_be_found)
+    recognizer = Recognizer(BOARD_SIZE, load_color_bounds(COLOR_PROFILE), verbose=False)
+    cascade = DetectionCascade(number_of_corners)
+    temporal_filter = TemporalFilter(BOARD_SIZE) if smoothing else None
+    published_grid = None
+
+    def locate(img):
+        # one ordered worker: the recognizer buffers, the cache and the seed of the cascade are only used here
+        gray = recognizer.prepare_gray(img)
+        if get_board_geometry(recognizer, gray, camera_id, cascade) is None:
+            return None
+        return recognizer.grid, (recognizer.avg_horizontal, recognizer.avg_vertical)
+
+    def publish(item):
+        nonlocal published_grid
+        if temporal_filter is not None and item["recognizer"].grid is not published_grid:
+            # other grid, other cells: the history of the old one means nothing any more
+            temporal_filter.reset()
+        published_grid = item["recognizer"].grid
+        publish_state(item["state"], temporal_filter, item["timestamp"])
+
+    grabber = FrameGrabber(camera_id)
+    grabber.start()
+
+    def frames():
+        while not grabber.stopped():
+            item = grabber.read()
+            if item is not None:
+                yield item[2]
+
+    pipeline = Pipeline(recognition_stages(locate, publish, recognizer.color_bounds, BOARD_SIZE, workers))
+    try:
+        pipeline.run(frames())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        grabber.stop()
+        grabber.join(timeout=2)
+    if grabber.error:
+        print("Error:", grabber.error)
+    pipeline.report()
+    cascade.report()
+    if stats is not None:
+        stats.report()
+        instrumentation.disable()
+
+def serve(camera_id=1, host=HOST, port=PORT, incremental=True, pipelined=False):
+    """
+    Long-running recognition service: the camera loop of stream() runs in a thread, so the camera and
+    the cached grid stay warm, and every change of the board is pushed to the clients of a local
+    BoardServer (JSON lines over TCP, see board_server.py). Stop it with Ctrl+C.
+    With pipelined=True the loop of stream_pipelined() is used instead (more cores, more frames per second).
+    """
+    server = BoardServer(get_publisher(), host, port)
+    if pipelined:
+        target, kwargs = stream_pipelined, {"camera_id": camera_id}
+    else:
+        target, kwargs = stream, {"camera_id": camera_id, "incremental": incremental, "show": False}
+    threading.Thread(target=target, kwargs=kwargs, daemon=True).start()
+    server.run()
 
 if __name__ == "__main__":
     main()
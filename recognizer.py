@@ -0,0 +1,283 @@
+import datetime
+import cv2
+import numpy as np
+
+from board_grid import BoardGrid
+from board_state import BoardState
+from cell_classifier import COLOR_BOUNDS, cell_sample_maps, classify_cells, labels_to_pieces
+from empty_board import EmptyBoardModel
+from instrumentation import count, stage, timed
+
+BOARD_SIZE = 15
+
+def determine_average_distances(corners, board_size=BOARD_SIZE):
+    corners_to_be_found = board_size - 1
+    corners = np.asarray(corners).reshape((corners_to_be_found, corners_to_be_found, 2))
+
+    # distances between neighbouring corners, horizontal and vertical
+    horizontal_distances = np.linalg.norm(np.diff(corners, axis=1), axis=2)
+    vertical_distances = np.linalg.norm(np.diff(corners, axis=0), axis=2)
+
+    # calculate average distances
+    avg_horizontal_distance = np.mean(horizontal_distances)
+    avg_vertical_distance = np.mean(vertical_distances)
+
+    return avg_horizontal_distance, avg_vertical_distance
+
+def get_coordinates(index, board_size=BOARD_SIZE):
+    x = index//board_size
+    y = index%board_size
+    return (x,y)
+
+def get_ellipse_centers(ellipses):
+    return [(int(ellipse[0][0]), int(ellipse[0][1])) for ellipse in ellipses]
+
+class FrameBuffers:
+    """
+    Named output buffers for the per-frame OpenCV calls. A buffer is only (re)allocated when it is
+    asked for with another shape or type, so in a stream with a fixed resolution every frame reuses them.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+class Recognizer:
+    """
+    Everything that is needed to recognize the pieces on one board: the color bounds, the grid
+    (and the spacing derived from it) and the gray, HSV and mask buffers that are reused for every frame.
+    One Recognizer per board or camera; several of them can run in parallel threads because
+    nothing is shared between instances. A single instance should only be used by one thread at a time,
+    unless every thread passes its own buffers (see color_masks).
+    """
+
+    def __init__(self, board_size=BOARD_SIZE, color_bounds=COLOR_BOUNDS, engine="ellipses", verbose=True,
+                 color_classifier="inrange"):
+        self.board_size = board_size
+        self.engine = engine
+        self.verbose = verbose
+        # "inrange": cvtColor to HSV and inRange per range, "lut": one table lookup per pixel (see color_lut.py)
+        self.color_classifier = color_classifier
+        self.color_lut = None
+        self.color_bounds = {}
+        self.set_color_bounds(color_bounds)
+
+        self.grid = None
+        self.avg_horizontal = None
+        self.avg_vertical = None
+        self.cell_centers = None
+        self.cell_maps = None
+        self.empty_board = None
+
+        self.buffers = FrameBuffers()
+
+    def set_color_bounds(self, color_bounds):
+        """color_bounds: {color: [(lower HSV, upper HSV), ...]}, more than one range is combined (red wraps around)."""
+        self.color_bounds = {color: [(np.array(lower, dtype=np.uint8), np.array(upper, dtype=np.uint8))
+                                     for lower, upper in bounds]
+                             for color, bounds in color_bounds.items()}
+        if self.color_classifier == "lut":
+            # imported here, color_lut uses the FrameBuffers of this module
+            from color_lut import ColorLUT
+            self.color_lut = ColorLUT(self.color_bounds)
+
+    def set_corners(self, corners):
+        """Fit the grid on the inner corners found by the chessboard detection."""
+        avg_distances = determine_average_distances(corners, self.board_size)
+        self.set_grid(BoardGrid.fit(corners, self.board_size), avg_distances)
+
+    def set_grid(self, grid, avg_distances):
+        self.grid = grid
+        self.avg_horizontal, self.avg_vertical = avg_distances
+        self.cell_centers = grid.cell_centers()
+        self.cell_maps = None
+        if self.empty_board is not None and not np.array_equal(self.empty_board.grid.homography, grid.homography):
+            # the reference shows the board where it was, not where it is now
+            self.empty_board = None
+
+    @timed("prepare_gray")
+    def prepare_gray(self, img, gray=None, blurred=None, blur_size=13):
+        """Gray and median blurred version of img for the chessboard detection, in the given or the pooled buffers."""
+        height, width = img.shape[:2]
+        if gray is None:
+            gray = self.buffers.get("gray", (height, width))
+        if blurred is None:
+            blurred = self.buffers.get("blurred", (height, width))
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.medianBlur(gray, blur_size, dst=blurred)
+        return blurred
+
+    @timed("color_masks")
+    def color_masks(self, img, hsv=None, masks=None, range_mask=None):
+        """
+        One mask per color, written in masks (a dict of buffers) or in the pooled buffers of this Recognizer.
+        Pooled masks are overwritten by the next frame, copy them if they need to be kept.
+        range_mask is the scratch buffer for colors with more than one range (red). Threads that share
+        a Recognizer have to pass hsv, masks and range_mask, otherwise they write in the same pooled buffers.
+        The "lut" classifier ignores hsv and range_mask, its scratch buffers are per thread already.
+        """
+        height, width = img.shape[:2]
+        if masks is None:
+            masks = {color: self.buffers.get("mask " + color, (height, width)) for color in self.color_bounds}
+        if self.color_lut is not None:
+            return self.color_lut.color_masks(img, masks)
+
+        if hsv is None:
+            hsv = self.buffers.get("hsv", (height, width, 3))
+        cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=hsv)
+
+        for color, bounds in self.color_bounds.items():
+            mask = masks[color]
+            (lower, upper), other_bounds = bounds[0], bounds[1:]
+            cv2.inRange(hsv, lower, upper, dst=mask)
+            for lower, upper in other_bounds:
+                # OR instead of adding the masks, 255 + 255 would overflow
+                if range_mask is None:
+                    range_mask = self.buffers.get("range mask", (height, width))
+                cv2.inRange(hsv, lower, upper, dst=range_mask)
+                cv2.bitwise_or(mask, range_mask, dst=mask)
+        return masks
+
+    def detect_ellipses(self, mask, shape="ellipses"):
+        with stage("findContours"):
+            contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        min_area = (self.avg_horizontal * self.avg_vertical)/60
+        max_area = (self.avg_horizontal * self.avg_vertical)+10
+        detected_ellipses = []
+        with stage("fitEllipse"):
+            for cnt in contours:
+                area = cv2.contourArea(cnt)
+                if max_area>=area >= min_area and len(cnt) >= 5:
+                    detected_ellipses.append(cv2.fitEllipse(cnt))
+        count("contours", len(contours))
+        if self.verbose:
+            print(f"Detected {len(detected_ellipses)} {shape}.")
+
+        return detected_ellipses
+
+    @timed("match_shapes_to_centers")
+    def match_shapes_to_centers(self, shapes, color):
+        """
+        Voor elk gedetecteerd object (cirkel of ellips), bepaal welk celcentrum het dichtstbijzijnde is.
+        """
+        list_shapes = []
+        if len(shapes) == 0:
+            return list_shapes
+
+        # afstanden van alle vormen tot alle celcentra in één keer, de index van het minimum is meteen de cel
+        differences = np.asarray(shapes, dtype=np.float64)[:, np.newaxis, :] - self.cell_centers[np.newaxis, :, :]
+        squared_distances = np.einsum("ijk,ijk->ij", differences, differences)
+        closest_indices = np.argmin(squared_distances, axis=1)
+        min_squared_distances = squared_distances[np.arange(len(shapes)), closest_indices]
+
+        max_distance=(self.avg_horizontal+self.avg_vertical)/2
+
+        for index, min_squared_distance in zip(closest_indices, min_squared_distances):
+            if min_squared_distance>max_distance**2:
+                continue
+
+            list_shapes.append((color,get_coordinates(int(index), self.board_size)))
+
+        return list_shapes
+
+    def find_pieces_with_ellipses(self, img):
+        list_shapes = []
+        ellipses = {}
+        for color, mask in self.color_masks(img).items():
+            ellipses[color] = self.detect_ellipses(mask, shape=f"{color} ellipses")
+            list_shapes += self.match_shapes_to_centers(get_ellipse_centers(ellipses[color]), color)
+        return list_shapes, ellipses
+
+    @timed("find_pieces_with_cells")
+    def find_pieces_with_cells(self, img):
+        if self.cell_maps is None:
+            self.cell_maps = cell_sample_maps(self.grid)
+        samples = self.buffers.get("cell samples", self.cell_maps[0].shape + img.shape[2:])
+        labels = classify_cells(img, self.grid, self.cell_maps, self.color_bounds, samples=samples)
+        list_shapes = labels_to_pieces(labels, self.board_size)
+        if self.verbose:
+            print(f"Detected {len(list_shapes)} pieces in the cells.")
+
+        return list_shapes, {}
+
+    def capture_empty_board(self, img, new=False):
+        """
+        Store img (the board without pieces, after the grid is set) as the reference of engine "reference".
+        More captures are averaged, new=True starts over.
+        """
+        if self.grid is None:
+            raise ValueError("The board has not been located yet, call set_corners or set_grid first.")
+        if self.empty_board is None or new:
+            self.empty_board = EmptyBoardModel(self.grid, self.color_bounds)
+        self.empty_board.capture(img)
+
+    def has_empty_board(self):
+        return self.empty_board is not None and self.empty_board.captured()
+
+    @timed("find_pieces_with_reference")
+    def find_pieces_with_reference(self, img):
+        if not self.has_empty_board():
+            raise ValueError("The empty board has not been captured yet, call capture_empty_board first.")
+        labels = self.empty_board.classify(img)
+        list_shapes = labels_to_pieces(labels, self.board_size)
+        if self.verbose:
+            print(f"Detected {len(list_shapes)} pieces that differ from the empty board.")
+
+        return list_shapes, {}
+
+    @timed("recognize")
+    def recognize(self, img, engine=None):
+        """
+        Headless recognition: opens no windows, draws nothing and leaves img untouched.
+        engine "ellipses" fits ellipses on the color masks of the whole image,
+        engine "cells" only looks at the middle of every cell of the grid (faster),
+        engine "reference" compares the middle of every cell with the empty board (capture_empty_board, see empty_board.py).
+        Use draw_overlay on the result to visualize it.
+        result["state"] is the same board as a BoardState, for comparing and diffing (see board_state.py).
+        """
+        if self.grid is None:
+            raise ValueError("The board has not been located yet, call set_corners or set_grid first.")
+
+        if (engine or self.engine) == "cells":
+            found_shapes, ellipses = self.find_pieces_with_cells(img)
+        elif (engine or self.engine) == "reference":
+            found_shapes, ellipses = self.find_pieces_with_reference(img)
+        else:
+            found_shapes, ellipses = self.find_pieces_with_ellipses(img)
+
+        pieces = list(set(found_shapes))
+        count("frames recognized")
+        count("pieces detected", len(pieces))
+        return {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "pieces": pieces,
+            "state": BoardState.from_pieces(pieces, self.board_size),
+            "ellipses": ellipses,
+            "cell_centers": self.cell_centers,
+            "board_size": self.board_size,
+        }
+
+def draw_overlay(img, result):
+    """Draws the ellipses and the cells of the recognized pieces on a copy of img."""
+    overlay = img.copy()
+    for color, ellipses in result["ellipses"].items():
+        for ellipse in ellipses:
+            cv2.ellipse(overlay, ellipse, (255, 0, 0) if color == "blue" else (0, 0, 255), 2)
+            cv2.circle(overlay, (int(ellipse[0][0]), int(ellipse[0][1])), 5, (0, 255, 255), -1)
+
+    for color, (row, column) in result["pieces"]:
+        center = tuple(map(int, result["cell_centers"][row * result["board_size"] + column]))
+        cv2.circle(overlay, center, 5, (255, 255, 0), -1)
+        cv2.circle(overlay, center, 15, (255, 0, 0) if color == "blue" else (0, 0, 255), 2)
+    return overlay
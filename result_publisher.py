@@ -0,0 +1,151 @@
+import atexit
+import datetime
+import json
+import os
+import queue
+import tempfile
+import threading
+
+from board_state import BOARD_SIZE, BoardState
+from instrumentation import count, stage
+
+# Writing detected_pieces.json in the recognition loop costs time every frame, and a program that
+# reads the file at the wrong moment sees half of it. The publisher only passes on a board state
+# when it differs from the last one, writes the file from its own thread into a temporary file
+# that replaces the old one in one step (os.replace), and hands the changes to callbacks and
+# queues, so the gomoku engine does not have to poll the file at all.
+# On Windows the replace fails while another program has the file open: the newest state is kept
+# and written again after a short wait, so the file does not stay behind until the board changes.
+
+RESULTS_PATH = 'detected_pieces.json'
+RETRY_DELAY = 0.05 # seconds before the first new attempt at a failed write, doubled per failure
+MAX_RETRY_DELAY = 1.0
+
+def write_atomic(path, data, compact=False):
+    """Writes data as JSON to a temporary file next to path, then replaces path with it."""
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(prefix=".detected_pieces_", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as json_file:
+            if compact:
+                json.dump(data, json_file, separators=(",", ":"), default=int)
+            else:
+                json.dump(data, json_file, indent=4, default=int)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+class ResultPublisher(threading.Thread):
+    """
+    publish(pieces) returns immediately. For every new board state the thread calls the callbacks and
+    fills the queues of subscribe() with a dict: timestamp, pieces, added and removed (lists of pieces),
+    board (BoardState.to_string) and conflicts (cells with both colors).
+    The file only gets the newest state: when several states are waiting, the older ones are not written.
+    A failed write is tried again (see RETRY_DELAY) until it succeeds or a newer state replaces it.
+    path=None publishes without writing a file.
+    """
+
+    def __init__(self, path=RESULTS_PATH, compact=False, board_size=BOARD_SIZE):
+        super().__init__(daemon=True)
+        self.path = path
+        self.compact = compact
+        self.board_size = board_size
+        self.changes = queue.Queue()
+        self.callbacks = []
+        self.queues = []
+        self.lock = threading.Lock()
+        self.state = None
+        self.published = 0
+        self.unchanged = 0
+        self.files_written = 0
+        self.write_retries = 0
+        self.error = None
+        self.unwritten = None # the newest state that is not in the file yet
+        self._stop_event = threading.Event()
+        atexit.register(self.close)
+        self.start()
+
+    def subscribe(self, callback=None):
+        """Register a callback (called from the publisher thread) or, without callback, get a new queue."""
+        with self.lock:
+            if callback is not None:
+                self.callbacks.append(callback)
+                return callback
+            changes = queue.Queue()
+            self.queues.append(changes)
+            return changes
+
+    def publish(self, pieces, timestamp=None):
+        """Pass on a detection (a list of pieces or a BoardState). Returns False when the board state did not change."""
+        state = pieces if isinstance(pieces, BoardState) else BoardState.from_pieces(pieces, self.board_size)
+        with self.lock:
+            if state == self.state:
+                self.unchanged += 1
+                count("publisher unchanged")
+                return False
+            previous, self.state = self.state, state
+            self.published += 1
+
+        added, removed = state.diff(previous or BoardState(board_size=state.board_size))
+        change = {
+            "timestamp": timestamp or datetime.datetime.now().isoformat(),
+            "pieces": state.to_pieces(),
+            "added": added,
+            "removed": removed,
+            "board": state.to_string(),
+            "conflicts": state.conflicts(),
+        }
+        self.changes.put(change)
+        count("publisher changes")
+        return True
+
+    def run(self):
+        retry_delay = RETRY_DELAY
+        while not (self._stop_event.is_set() and self.changes.empty() and self.unwritten is None):
+            try:
+                change = self.changes.get(timeout=retry_delay if self.unwritten is not None else 0.1)
+                pending = [change]
+            except queue.Empty:
+                pending = []
+            while pending:
+                try:
+                    pending.append(self.changes.get_nowait())
+                except queue.Empty:
+                    break
+
+            with self.lock:
+                callbacks, queues = list(self.callbacks), list(self.queues)
+            for change in pending:
+                for callback in callbacks:
+                    try:
+                        callback(change)
+                    except Exception as error:
+                        # a broken subscriber should not stop the file and the other subscribers
+                        print("Error in result callback:", repr(error))
+                for changes in queues:
+                    changes.put(change)
+
+            if self.path is not None and pending:
+                self.unwritten = {key: pending[-1][key] for key in ["timestamp", "pieces", "board", "conflicts"]}
+            if self.unwritten is None:
+                continue
+            try:
+                with stage("json write"):
+                    write_atomic(self.path, self.unwritten, self.compact)
+                self.files_written += 1
+                self.unwritten = None
+                retry_delay = RETRY_DELAY
+            except OSError as error:
+                # e.g. PermissionError on Windows while a reader has the file open
+                if self.error is None or retry_delay == RETRY_DELAY:
+                    print("Error: could not write", self.path, error, "- trying again")
+                self.error = error
+                self.write_retries += 1
+                retry_delay = min(2 * retry_delay, MAX_RETRY_DELAY)
+
+    def close(self, timeout=5):
+        """Write what is still waiting and stop the thread."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
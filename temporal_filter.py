@@ -0,0 +1,57 @@
+import numpy as np
+
+from board_state import BOARD_SIZE, BoardState, CONFLICT
+
+# One frame with a hand, a shadow or glare on the board adds or removes pieces that are not there.
+# The filter keeps the cell values of the last frames in a ring buffer and a cell only changes when
+# one value has min_votes of them. Below that the cell keeps its old value (hysteresis), so a cell
+# that flickers between two values does not switch back and forth. Per frame this is one row copy
+# and one comparison of the whole buffer.
+
+HISTORY = 5
+MIN_VOTES = 4
+NUMBER_OF_VALUES = CONFLICT + 1
+
+class TemporalFilter:
+    def __init__(self, board_size=BOARD_SIZE, history=HISTORY, min_votes=MIN_VOTES):
+        if not history / 2 < min_votes <= history:
+            raise ValueError("min_votes has to be a majority of history")
+        self.board_size = board_size
+        self.history = history
+        self.min_votes = min_votes
+        self.frames = np.zeros((history, board_size * board_size), dtype=np.int8)
+        self.frames_seen = 0
+        self.state = BoardState(board_size=board_size)
+        self.values = np.arange(NUMBER_OF_VALUES, dtype=np.int8)[:, np.newaxis, np.newaxis]
+
+    def ready(self):
+        """False until enough frames were seen for a first stable state."""
+        return self.frames_seen >= self.min_votes
+
+    def reset(self):
+        """Forget the history, for example when the board was moved."""
+        self.frames_seen = 0
+        self.state = BoardState(board_size=self.board_size)
+
+    def update(self, state):
+        """
+        Add the state of the next frame. Returns (stable state, added, removed): the stable state after this
+        frame and the pieces that became stable or disappeared in this frame (see BoardState.diff).
+        """
+        self.frames[self.frames_seen % self.history] = state.cells.reshape(-1)
+        self.frames_seen += 1
+        frames = self.frames[:min(self.frames_seen, self.history)]
+
+        # votes[value, cell]: in how many of the remembered frames the cell had that value
+        votes = (frames[np.newaxis] == self.values).sum(axis=1)
+        winner = votes.argmax(axis=0).astype(np.int8)
+        stable = votes.max(axis=0) >= self.min_votes
+
+        cells = self.state.cells.reshape(-1)
+        new_cells = np.where(stable, winner, cells)
+        if np.array_equal(new_cells, cells):
+            return self.state, [], []
+
+        previous, self.state = self.state, BoardState(new_cells, self.board_size)
+        added, removed = self.state.diff(previous)
+        return self.state, added, removed
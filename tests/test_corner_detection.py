@@ -0,0 +1,34 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corner_detection import find_corners_from_seed
+
+BOARD_SIZE = 15
+CELL = 40
+NUMBER_OF_CORNERS = (BOARD_SIZE - 1, BOARD_SIZE - 1)
+
+def make_board():
+    """A sharp black and white board of BOARD_SIZE cells with one cell of white margin, and its inner corners."""
+    size = (BOARD_SIZE + 2) * CELL
+    gray = np.full((size, size), 255, dtype=np.uint8)
+    for row in range(BOARD_SIZE):
+        for column in range(BOARD_SIZE):
+            if (row + column) % 2 == 0:
+                gray[(row + 1) * CELL:(row + 2) * CELL, (column + 1) * CELL:(column + 2) * CELL] = 0
+    columns, rows = np.meshgrid(np.arange(2, BOARD_SIZE + 1), np.arange(2, BOARD_SIZE + 1))
+    corners = np.stack([columns, rows], axis=-1).reshape(-1, 1, 2) * CELL - 0.5
+    return gray, corners.astype(np.float32)
+
+def test_seed_is_refined_on_the_board():
+    gray, corners = make_board()
+    found = find_corners_from_seed(gray, NUMBER_OF_CORNERS, corners + np.float32([1.5, -1.0]))
+    assert found is not None
+    assert np.abs(found - corners).max() < 0.5
+
+def test_seed_is_rejected_without_a_board():
+    _, corners = make_board()
+    flat = np.full((BOARD_SIZE + 2) * CELL * np.array([1, 1]), 128, dtype=np.uint8)
+    assert find_corners_from_seed(flat, NUMBER_OF_CORNERS, corners) is None
@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from board_grid import BoardGrid
+from pipeline import Pipeline, recognition_stages
+from recognizer import Recognizer
+
+BOARD_SIZE = 15
+CELL = 40
+
+def make_grid():
+    return BoardGrid([[CELL, 0, CELL], [0, CELL, CELL], [0, 0, 1]], BOARD_SIZE)
+
+def make_frame(seed):
+    """A board with red (both hue ranges) and blue pieces on random cells, plus noise."""
+    rng = np.random.default_rng(seed)
+    size = (BOARD_SIZE + 2) * CELL
+    hsv = np.zeros((size, size, 3), dtype=np.uint8)
+    hsv[..., 2] = rng.integers(0, 256, (size, size))
+    grid = make_grid()
+    for index, center in enumerate(grid.cell_centers()):
+        kind = rng.integers(0, 4)
+        if kind == 0:
+            continue
+        hue = (2, 176, 120)[kind - 1]
+        cv2.circle(hsv, tuple(int(value) for value in center), CELL // 3, (hue, 220, 200), -1)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+def make_recognizer(color_classifier="inrange"):
+    recognizer = Recognizer(BOARD_SIZE, verbose=False, color_classifier=color_classifier)
+    recognizer.set_grid(make_grid(), (CELL, CELL))
+    return recognizer
+
+def own_buffers(frame, recognizer):
+    height, width = frame.shape[:2]
+    return {
+        "hsv": np.empty((height, width, 3), dtype=np.uint8),
+        "masks": {color: np.empty((height, width), dtype=np.uint8) for color in recognizer.color_bounds},
+        "range_mask": np.empty((height, width), dtype=np.uint8),
+    }
+
+@pytest.mark.parametrize("color_classifier", ["inrange", "lut"])
+def test_color_masks_in_two_threads_match_a_single_thread(color_classifier):
+    frames = [make_frame(seed) for seed in range(8)]
+    single = make_recognizer()
+    expected = [{color: mask.copy() for color, mask in single.color_masks(frame).items()} for frame in frames]
+
+    shared = make_recognizer(color_classifier)
+    results = [[] for _ in range(2)]
+
+    def work(worker):
+        for _ in range(15):
+            for index, frame in enumerate(frames):
+                masks = shared.color_masks(frame, **own_buffers(frame, shared))
+                results[worker].append((index, masks))
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for worker_results in results:
+        assert len(worker_results) == 15 * len(frames)
+        for index, masks in worker_results:
+            for color, mask in masks.items():
+                assert np.array_equal(mask, expected[index][color])
+
+def test_pipeline_with_two_workers_matches_sequential_recognition():
+    frames = [make_frame(seed) for seed in range(12)]
+    expected = [make_recognizer().recognize(frame)["state"] for frame in frames]
+
+    grid = make_grid()
+    published = []
+    stages = recognition_stages(lambda frame: (grid, (CELL, CELL)), lambda item: published.append(item["state"]),
+                                board_size=BOARD_SIZE, workers=2)
+    Pipeline(stages).run(frames)
+
+    assert published == expected
@@ -0,0 +1,32 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import result_publisher
+from result_publisher import ResultPublisher
+
+def test_failed_write_is_retried_without_a_new_state(tmp_path, monkeypatch):
+    path = tmp_path / "detected_pieces.json"
+    replace = os.replace
+    failures = []
+
+    def locked_replace(source, destination):
+        # the first attempts fail like on Windows while a reader has the file open
+        if len(failures) < 3:
+            failures.append(destination)
+            raise PermissionError(13, "The process cannot access the file", destination)
+        replace(source, destination)
+
+    monkeypatch.setattr(result_publisher.os, "replace", locked_replace)
+    publisher = ResultPublisher(str(path))
+    publisher.publish([("red", (1, 2))])
+    publisher.close()
+
+    assert not publisher.is_alive()
+    assert publisher.write_retries == 3
+    assert publisher.files_written == 1
+    with open(path) as json_file:
+        assert json.load(json_file)["pieces"] == [["red", [1, 2]]]
+    assert not [name for name in os.listdir(tmp_path) if name.startswith(".detected_pieces_")]